@@ -1,19 +1,20 @@
 -- schema.sql
 
+-- 由www/schema.py根据models.py生成，修改表结构请改models.py后执行：python3 schema.py create > ../schema.sql
+
 drop database if exists awesome;
 
 create database awesome;
 
 use awesome;
 
-grant select, insert, update, delete on awesome.* to 'www-data'@'localhost' identified by 'www-data';
+-- grant select, insert, update, delete on awesome.* to 'www-data'@'localhost' identified by '<password>';
 
-# 初始化三个数据表，顾名思义，赋值初始类型
 create table users (
     `id` varchar(50) not null,
     `email` varchar(50) not null,
     `passwd` varchar(50) not null,
-    `admin` bool not null,
+    `admin` boolean not null,
     `name` varchar(50) not null,
     `image` varchar(500) not null,
     `created_at` real not null,
@@ -30,6 +31,7 @@ create table blogs (
     `name` varchar(50) not null,
     `summary` varchar(200) not null,
     `content` mediumtext not null,
+    `html_content` mediumtext,
     `created_at` real not null,
     key `idx_created_at` (`created_at`),
     primary key (`id`)
@@ -42,7 +44,10 @@ create table comments (
     `user_name` varchar(50) not null,
     `user_image` varchar(500) not null,
     `content` mediumtext not null,
+    `html_content` mediumtext,
     `created_at` real not null,
     key `idx_created_at` (`created_at`),
+    key `idx_blog_id_created_at` (`blog_id`, `created_at`),
+    key `idx_user_id` (`user_id`),
     primary key (`id`)
-) engine=innodb default charset=utf8;
\ No newline at end of file
+) engine=innodb default charset=utf8;
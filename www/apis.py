@@ -1,4 +1,4 @@
-import json, logging, inspect, functools
+import json, logging, inspect, functools, base64
 
 
 # 建立Page类来处理分页,可以在page_size更改每页项目的个数（这里默认为八个）
@@ -27,6 +27,40 @@ class Page(object):
 
     __repr__ = __str__
 
+# 游标分页用的Page，不计算offset，而是返回指向下一页/上一页的不透明游标；没有查总数时item_count为None
+class CursorPage(object):
+
+    def __init__(self, item_count, page_size=8, next=None, prev=None):
+        self.item_count = item_count
+        self.page_size = page_size
+        self.next = next
+        self.prev = prev
+        self.has_next = next is not None
+        self.has_previous = prev is not None
+
+    def __str__(self):
+        return 'item_count: %s, page_size: %s, next: %s, prev: %s' % (self.item_count, self.page_size, self.next, self.prev)
+
+    __repr__ = __str__
+
+# 游标编码：方向('n'下一页/'p'上一页) + (created_at, id)，base64后对客户端不透明
+def encode_cursor(direction, created_at, id):
+    s = '%s|%r|%s' % (direction, created_at, id)
+    return base64.urlsafe_b64encode(s.encode('utf-8')).decode('ascii').rstrip('=')
+
+# 解析游标，空字符串表示第一页，返回(direction, (created_at, id)或None)
+def decode_cursor(cursor):
+    if not cursor:
+        return 'n', None
+    try:
+        s = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8')
+        direction, created_at, id = s.split('|', 2)
+        if direction not in ('n', 'p'):
+            raise ValueError(direction)
+        return direction, (float(created_at), id)
+    except ValueError:
+        raise APIValueError('cursor', 'Invalid cursor.')
+
 # 以下为API的几类错误代码
 class APIError(Exception):
     def __init__(self, error, data='', message=''):
@@ -2,30 +2,41 @@ import logging
 
 logging.basicConfig(level=logging.INFO)
 
-import asyncio, os, json, time
-from datetime import datetime
+import asyncio, os, time, socket, signal, argparse
 from aiohttp import web
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
 
 # config 配置代码在后面会创建添加, 可先从'https://github.com/yzyly1992/2019_Python_Web_Dev'下载或下一章中复制`config.py`和`config_default.py`到`www`下,以防报错
 from config import configs
-import orm
-from coroweb import add_routes, add_static
+import orm, encoder, metrics, logconfig, search, executor
+from coroweb import add_routes, add_static, read_body
 # handlers 是url处理模块, 当handlers.py在API章节里完全编辑完再将下一行代码的双井号去掉
-from handlers import cookie2user, COOKIE_NAME
+from handlers import cookie2user, COOKIE_NAME, page_cache, datetime_filter
 
 
 # 初始化jinja2的函数（用于传送html模板）
+# debug=False为生产模式：不再检查模板文件是否修改，启动时预编译所有模板，并把字节码缓存到磁盘供各进程共享
 def init_jinja2(app, **kw):
     logging.info('init jinja2...')
+    debug = kw.get('debug', True)
     options = dict(
         autoescape=kw.get('autoescape', True),
         block_start_string=kw.get('block_start_string', '{%'),
         block_end_string=kw.get('block_end_string', '%}'),
         variable_start_string=kw.get('variable_start_string', '{{'),
         variable_end_string=kw.get('variable_end_string', '}}'),
-        auto_reload=kw.get('auto_reload', True)
+        auto_reload=kw.get('auto_reload', debug),
+        # 异步模式下用generate_async流式渲染，不再调用同步的render()
+        enable_async=kw.get('enable_async', False)
     )
+    if not debug:
+        # cache_dir为None时使用jinja2默认的临时目录
+        cache_dir = kw.get('cache_dir', None)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        # 同步和异步模式编译出的字节码不通用，而缓存的key只有模板名和路径，两种模式要用不同的文件名
+        pattern = '__jinja2_%s.async.cache' if options['enable_async'] else '__jinja2_%s.cache'
+        options['bytecode_cache'] = FileSystemBytecodeCache(cache_dir, pattern)
     path = kw.get('path', None)
     if path is None:
         path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
@@ -37,19 +48,80 @@ def init_jinja2(app, **kw):
     if filters is not None:
         for name, f in filters.items():
             env.filters[name] = f
+    if not debug:
+        # 预编译全部模板，第一个请求就不用再编译了
+        for name in env.list_templates(extensions=['html']):
+            env.get_template(name)
+            logging.info('precompiled template: %s' % name)
     app['__templating__'] = env
 
 
 # middleware是一种拦截器，一个URL在被某个函数处理前，可以经过一系列的middleware的处理
 # 以下是middleware,可以把通用的功能从每个URL处理函数中拿出来集中放到一个地方
 # URL处理函数运行前进行一次拦截，响应生成前进行一次拦截
-# URL处理日志工厂（拦截器）
+# 响应body的字节数：普通Response此时还没发送，取body长度；已经流式发送完的取实际写出的长度
+def response_size(resp):
+    if type(resp) is web.Response or not resp.prepared:
+        body = getattr(resp, 'body', None)
+        return len(body) if isinstance(body, (bytes, bytearray)) else 0
+    return resp.body_length
+
+
+# 指标工厂（拦截器）--放在最外层，按路由模板（如/blog/{id}）记录延迟、状态码、响应字节数和正在处理的请求数
+def route_name(request):
+    route = request.match_info.route
+    resource = getattr(route, 'resource', None)
+    if resource is None:
+        return '<unmatched>'
+    canonical = getattr(resource, 'canonical', None)
+    if canonical:
+        return canonical
+    info = resource.get_info()
+    return info.get('formatter') or info.get('path') or info.get('prefix') or '<unknown>'
+
+async def metrics_factory(app, handler):
+    async def record(request):
+        start = time.time()
+        metrics.http.in_flight += 1
+        status = 500
+        size = 0
+        try:
+            resp = await handler(request)
+            status = resp.status
+            size = response_size(resp)
+            return resp
+        except web.HTTPException as e:
+            status = e.status
+            raise
+        finally:
+            metrics.http.in_flight -= 1
+            metrics.http.observe(request.method, route_name(request), status, size, time.time() - start)
+
+    return record
+
+
+# URL处理日志工厂（拦截器）--每个请求结束后只写一行访问日志：方法 路径 状态码 字节数 耗时 用户
+access_log = logging.getLogger('access')
+
 async def logger_factory(app, handler):
     async def logger(request):
-        # 打印URL的方法和路径
-        logging.info('Request: %s %s' % (request.method, request.path))
-        # 再执行URL处理
-        return (await handler(request))
+        start = time.time()
+        status = 500
+        size = 0
+        try:
+            # 再执行URL处理
+            resp = await handler(request)
+            status = resp.status
+            size = response_size(resp)
+            return resp
+        except web.HTTPException as e:
+            status = e.status
+            raise
+        finally:
+            if access_log.isEnabledFor(logging.INFO):
+                user = getattr(request, '__user__', None)
+                access_log.info('%s %s %s %s %.1fms %s', request.method, request.path_qs, status, size,
+                                (time.time() - start) * 1000, user.id if user else '-')
 
     return logger
 
@@ -58,13 +130,11 @@ async def logger_factory(app, handler):
 # 需要handlers.py的支持, 当handlers.py在API章节里完全编辑完再将下面代码的双井号去掉
 async def auth_factory(app, handler):
     async def auth ( request ) :
-        logging.info('check user: %s %s' % (request.method, request.path))
         request.__user__ = None
         cookie_str = request.cookies.get(COOKIE_NAME)
         if cookie_str :
             user = await cookie2user(cookie_str)
             if user :
-                logging.info('set current user: %s' % user.email)
                 request.__user__ = user
         if request.path.startswith('/manage/') and (request.__user__ is None or not request.__user__.admin) :
             return web.HTTPFound('/signin')
@@ -73,31 +143,166 @@ async def auth_factory(app, handler):
     return auth
 
 
+# 读写分离工厂（拦截器）--写过数据库的请求返回一个短期cookie，
+# 客户端在pin_seconds秒内带着它回来时，本次请求的读也走主库，这样发表评论后刷新页面一定能看到新评论
+PIN_COOKIE_NAME = 'awepin'
+
+async def db_route_factory(app, handler):
+    async def db_route(request):
+        if request.cookies.get(PIN_COOKIE_NAME):
+            orm.pin_primary()
+        resp = await handler(request)
+        if orm.has_written() and isinstance(resp, web.StreamResponse) and not resp.prepared:
+            resp.set_cookie(PIN_COOKIE_NAME, '1', max_age=configs.db.pin_seconds, httponly=True)
+        return resp
+
+    return db_route
+
+
+# 整页缓存工厂（拦截器）--放在response_factory外层，缓存的是最终编码好的响应body
+# 只缓存带@cache_page标记的GET请求，匿名用户共享一份，登录用户按用户id各存一份
+async def page_cache_factory(app, handler):
+    def cached_response(entry, state):
+        resp = web.Response(body=entry[0], headers={'Content-Type': entry[1]})
+        resp.headers['X-Cache'] = state
+        return resp
+
+    async def page_cache_handler(request):
+        if request.method != 'GET' or not getattr(request.match_info.handler, '_cache_page', False):
+            return (await handler(request))
+        user = await cookie2user(request.cookies.get(COOKIE_NAME))
+        # 命中缓存时不会再经过auth_factory，先绑定到request上，访问日志才能记录用户
+        request.__user__ = user
+        key = (request.path, request.query_string, user.id if user else '')
+        entry, state = page_cache.get(key)
+        if state == 'fresh':
+            page_cache.hits += 1
+            return cached_response(entry, 'HIT')
+        pending = page_cache.pending(key)
+        if pending is not None:
+            if entry is not None:
+                # 已有请求在重新生成，先返回旧内容
+                page_cache.stale_hits += 1
+                return cached_response(entry, 'STALE')
+            entry = await asyncio.shield(pending)
+            if entry is not None:
+                page_cache.hits += 1
+                return cached_response(entry, 'HIT')
+        page_cache.misses += 1
+        generation = page_cache.generation(request.path)
+        if time.time() - page_cache.invalidated_at(request.path) < configs.db.pin_seconds:
+            # 刚被写操作失效的页面，从库可能还没同步到这次写入，从主库读，免得把旧数据再缓存ttl秒
+            orm.pin_primary()
+        fut = page_cache.begin(key)
+        entry = None
+        try:
+            resp = await handler(request)
+            if type(resp) is web.Response:
+                body = resp.body
+            else:
+                # 流式渲染的页面在写完后把完整的body放在resp['__body__']
+                body = resp.get('__body__') if isinstance(resp, web.StreamResponse) else None
+            if body is not None and resp.status == 200 and not resp.cookies:
+                entry = page_cache.put(key, body, resp.headers.get('Content-Type'), generation)
+                if not resp.prepared:
+                    resp.headers['X-Cache'] = 'MISS'
+            return resp
+        finally:
+            page_cache.end(key, fut, entry)
+
+    return page_cache_handler
+
+
 # 数据处理工厂（拦截器）
 # 这里的app就是里面的request
 async def data_factory(app, handler):
     async def parse_data(request):
+        # 解析结果保存在request.__data__上，RequestHandler不会再解析一次
         if request.method == 'POST' :
             if request.content_type.startswith('application/json') :
-                request.__data__ = await request.json()
-                logging.info('request json: %s' % str(request.__data__))
+                await read_body(request)
+                logging.debug('request json: %s', getattr(request, '__data__', None))
             elif request.content_type.startswith('application/x-www-form-urlencoded') :
-                request.__data__ = await request.post()
-                logging.info('request form: %s' % str(request.__data__))
+                await read_body(request)
+                logging.debug('request form: %s', getattr(request, '__data__', None))
         return (await handler(request))
 
     return parse_data
 
 
+# 把异步迭代器（如Model.iterAll）的结果流式输出为JSON数组
+# 使用分块传输编码，攒够chunk_size字节就写出一次，内存占用和首字节时间都与结果集大小无关
+async def stream_json(request, items, chunk_size=64 * 1024):
+    resp = web.StreamResponse()
+    resp.content_type = 'application/json'
+    resp.charset = 'utf-8'
+    resp.enable_chunked_encoding()
+    await resp.prepare(request)
+    buf = [b'[']
+    size = 1
+    sep = b''
+    try:
+        async for item in items:
+            data = sep + encoder.dumps(item)
+            sep = b','
+            buf.append(data)
+            size = size + len(data)
+            if size >= chunk_size:
+                await resp.write(b''.join(buf))
+                buf = []
+                size = 0
+        buf.append(b']')
+        await resp.write(b''.join(buf))
+        await resp.write_eof()
+    finally:
+        # 客户端断开等情况下提前结束，也要让迭代器释放数据库连接
+        if hasattr(items, 'aclose'):
+            await items.aclose()
+    return resp
+
+
+# 流式渲染模板：先发送响应头，再把generate_async产生的片段攒够chunk_size就写出一次
+# 这样__base__.html里的头部和导航先到达浏览器，评论列表还在渲染；每写一块都让出事件循环
+# collect=True时同时保存完整的body到resp['__body__']，供整页缓存使用
+async def stream_template(request, template, context, collect=False, chunk_size=8 * 1024):
+    resp = web.StreamResponse()
+    resp.content_type = 'text/html'
+    resp.charset = 'utf-8'
+    resp.enable_chunked_encoding()
+    await resp.prepare(request)
+    body = [] if collect else None
+    buf = []
+    size = 0
+    async for s in template.generate_async(**context):
+        buf.append(s)
+        size = size + len(s)
+        if size >= chunk_size:
+            data = ''.join(buf).encode('utf-8')
+            await resp.write(data)
+            if collect:
+                body.append(data)
+            buf = []
+            size = 0
+            await asyncio.sleep(0)
+    data = ''.join(buf).encode('utf-8')
+    await resp.write(data)
+    await resp.write_eof()
+    if collect:
+        body.append(data)
+        resp['__body__'] = b''.join(body)
+    return resp
+
+
 # 响应返回处理工厂（拦截器）
 # 接受的参数分别为请求实例和处理程序
 async def response_factory(app, handler):
     async def response(request):
-        logging.info('Response handler...')
         # 先得到URL处理后的数据，最终就可以得到response对象
         r = await handler(request)
         if isinstance(r, web.StreamResponse):
             return r
+        if hasattr(r, '__aiter__'):
+            return (await stream_json(request, r))
         if isinstance(r, bytes):
             resp = web.Response(body=r)
             resp.content_type = 'application/octet-stream'
@@ -111,13 +316,18 @@ async def response_factory(app, handler):
         if isinstance(r, dict):
             template = r.get('__template__')
             if template is None:
-                resp = web.Response(
-                    body=json.dumps(r, ensure_ascii=False, default=lambda o: o.__dict__).encode('utf-8'))
+                resp = web.Response(body=encoder.dumps(r))
                 resp.content_type = 'application/json;charset=utf-8'
                 return resp
             else:
                 r['__user__'] = request.__user__
-                resp = web.Response(body=app['__templating__'].get_template(template).render(**r).encode('utf-8'))
+                env = app['__templating__']
+                if env.is_async:
+                    return (await stream_template(request, env.get_template(template), r,
+                                                  collect=getattr(request.match_info.handler, '_cache_page', False)))
+                # 非流式渲染整个页面是一次较长的同步调用，放到线程池里执行
+                body = await executor.run_local(env.get_template(template).render, r)
+                resp = web.Response(body=body.encode('utf-8'))
                 resp.content_type = 'text/html;charset=utf-8'
                 return resp
         if isinstance(r, int) and r >= 100 and r < 600:
@@ -135,40 +345,145 @@ async def response_factory(app, handler):
     return response
 
 
-# 时间转换
-def datetime_filter(t):
-    delta = int(time.time() - t)
-    if delta < 60 :
-        return u'1分钟前'
-    if delta < 3600 :
-        return u'%s分钟前' % (delta // 60)
-    if delta < 86400 :
-        return u'%s小时前' % (delta // 3600)
-    if delta < 604800 :
-        return u'%s天前' % (delta // 86400)
-    dt = datetime.fromtimestamp(t)
-    return u'%s年%s月%s日' % (dt.year, dt.month, dt.day)
+
+# 多进程模式下每个worker单独提供的/metrics，只包含本worker的数据
+async def worker_metrics(request):
+    r = web.Response(body=metrics.render().encode('utf-8'))
+    r.headers['Content-Type'] = metrics.CONTENT_TYPE
+    return r
 
 
 # Web App骨架（上面的全是后期增添内容）
-async def init(loop):
+# sock不为None时（多进程模式）使用主进程创建好的监听socket，worker为该worker的序号
+async def init(loop, sock=None, worker=None):
+    if worker is not None:
+        metrics.worker_port = configs.server.metrics_port
+        metrics.set_process_labels([('worker', worker), ('pid', os.getpid())])
+        metrics_app = web.Application(loop=loop)
+        metrics_app.router.add_route('GET', '/metrics', worker_metrics)
+        await loop.create_server(metrics_app.make_handler(access_log=None), configs.server.host, metrics.worker_port + worker)
+    encoder.use_backend(configs.json.backend)
+    executor.setup(**configs.executor)
     await orm.create_pool(loop=loop, **configs.db)
+    # 初始化各表行数，并定期校准
+    await orm.seed_counts()
+    loop.create_task(orm.reconcile_counts(configs.orm.count_reconcile))
+    # 后台建立搜索索引（rebuild_interval不为0时还会定期重建）
+    loop.create_task(search.run(configs.search.rebuild_interval))
     # 从aiohttp模块中调用WSGI接口方法，将客户端请求抛给web应用程序去处理，并启动拦截器
     # app是一个请求实例
     app = web.Application(loop=loop, middlewares=[
-        logger_factory, response_factory, auth_factory
+        metrics_factory, logger_factory, db_route_factory, page_cache_factory, response_factory, auth_factory
     ])
     # 注册模板
-    init_jinja2(app, filters=dict(datetime=datetime_filter))
+    init_jinja2(app, filters=dict(datetime=datetime_filter), debug=configs.debug, cache_dir=configs.templates.cache_dir,
+                enable_async=configs.templates.streaming)
     # 注册url处理函数，注册后得到响应体response
     add_routes(app, 'handlers')
     # 注册静态文件
     add_static(app)
-    srv = await loop.create_server(app.make_handler(), '127.0.0.1', 9000)
-    logging.info('server started at http://127.0.0.1:9000...')
+    # 访问日志由logger_factory每个请求写一行，关掉aiohttp自带的aiohttp.access日志
+    if sock is None:
+        srv = await loop.create_server(app.make_handler(access_log=None), configs.server.host, configs.server.port)
+    else:
+        srv = await loop.create_server(app.make_handler(access_log=None), sock=sock)
+    logging.info('server started at http://%s:%s... (pid %s)' % (configs.server.host, configs.server.port, os.getpid()))
     return srv
 
 
-loop = asyncio.get_event_loop()
-loop.run_until_complete(init(loop))
-loop.run_forever()
+# 单个worker进程：自己的事件循环和自己的数据库连接池，收到SIGTERM/SIGINT/SIGHUP时退出
+def run_worker(sock=None, worker=None):
+    init_logging()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+        signal.signal(sig, signal.SIG_DFL)
+        loop.add_signal_handler(sig, loop.stop)
+    loop.run_until_complete(init(loop, sock, worker))
+    loop.run_forever()
+    loop.close()
+
+
+# 多进程（prefork）模式：主进程创建监听socket后fork出workers个子进程共享它
+# 主进程只负责监督：子进程意外退出时重新拉起；SIGTERM/SIGINT转发给所有子进程后退出；
+# SIGHUP转发给子进程让它们退出，随后逐个重新拉起，相当于重启所有worker
+# 整页缓存和登录缓存的失效通过共享内存（shared.Generations）通知到所有worker，各表行数也在共享内存里（shared.Counters）
+# 指标按worker分别导出：每个worker在server.metrics_port+序号上提供自己的/metrics，样本带worker和pid标签
+# 注意：搜索索引仍是每个worker各一份，一个worker里的写操作不会更新其他worker的索引，
+# 所以默认（supervisor配置和server.workers）仍是单进程
+def run_master(workers):
+    init_logging(background=False)
+    logging.warning('running %s workers: search index is per process, '
+                    'search results may differ between workers until the next rebuild' % workers)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((configs.server.host, configs.server.port))
+    sock.listen(configs.server.backlog)
+    sock.setblocking(False)
+    children = dict() # pid ==> (worker序号, 启动时间)，重新拉起的worker沿用原来的序号
+    stopping = []
+
+    def spawn(index):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                run_worker(sock, index)
+            except BaseException as e:
+                logging.exception(e)
+                code = 1
+            finally:
+                # os._exit不会执行atexit，先把日志队列里剩下的记录写完
+                logconfig.shutdown()
+                os._exit(code)
+        children[pid] = (index, time.time())
+        logging.info('worker %s started (pid %s, metrics on port %s)' % (index, pid, configs.server.metrics_port + index))
+
+    def forward(sig, frame):
+        if sig != signal.SIGHUP:
+            stopping.append(sig)
+        for pid in list(children):
+            try:
+                os.kill(pid, sig)
+            except ProcessLookupError:
+                pass
+
+    for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+        signal.signal(sig, forward)
+    for i in range(workers):
+        spawn(i)
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        child = children.pop(pid, None)
+        if child is None:
+            continue
+        index, started = child
+        logging.info('worker %s exited with status %s (pid %s)' % (index, status, pid))
+        if not stopping:
+            # 启动后很快就退出的，稍等一下再拉起，避免疯狂重启
+            if time.time() - started < 1:
+                time.sleep(1)
+            spawn(index)
+    sock.close()
+
+
+def init_logging(background=True):
+    logconfig.setup(configs.logging.level, background=background)
+    orm.set_log_sample_rate(configs.logging.sql_sample_rate)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Awesome web app.')
+    parser.add_argument('--workers', type=int, default=configs.server.workers, help='number of worker processes')
+    args = parser.parse_args(argv)
+    if args.workers > 1:
+        run_master(args.workers)
+    else:
+        run_worker()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+# 为预渲染功能上线之前的旧数据补齐html_content
+# 升级已有数据库时先执行：
+#   alter table blogs add column `html_content` mediumtext after `content`;
+#   alter table comments add column `html_content` mediumtext after `content`;
+# 然后运行：python3 backfill_html.py
+import asyncio, logging
+
+logging.basicConfig(level=logging.INFO)
+
+import orm
+from config import configs
+from models import Blog, Comment
+from handlers import markdown_html
+
+BATCH_SIZE = 100
+
+
+async def backfill(model):
+    total = 0
+    # 用流式游标遍历，不管有多少旧数据都不会一次性载入内存
+    async for r in model.iterAll("`html_content` is null or `html_content`=''", chunk_size=BATCH_SIZE):
+        html = await markdown_html(r.content)
+        # 只写html_content一列，并且要求content没变：遍历期间线上被编辑过的行不覆盖（编辑时已经渲染过）
+        await model.updateWhere('`html_content`=?', '`id`=? and `content`=?', [html, r.id, r.content])
+        total = total + 1
+        if total % BATCH_SIZE == 0:
+            logging.info('backfill %s: %s rows' % (model.__table__, total))
+    logging.info('backfill %s: %s rows' % (model.__table__, total))
+    return total
+
+
+async def main(loop):
+    await orm.create_pool(loop=loop, **configs.db)
+    for model in (Blog, Comment):
+        await backfill(model)
+
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main(loop))
+    print('Backfill finished.')
+    loop.close()
@@ -0,0 +1,357 @@
+# ORM相关的性能测试，需要先按schema.sql建好数据库
+# 用法：python3 bench.py saveall [N]
+#       python3 bench.py tx [N]
+#       python3 bench.py findall [N]   （不需要数据库）
+#       python3 bench.py rows [N]      （不需要数据库）
+#       python3 bench.py json [N]      （不需要数据库）
+#       python3 bench.py dispatch [N]  （不需要数据库）
+#       python3 bench.py search [N]    （不需要数据库）
+#       python3 bench.py executor [N]  （不需要数据库）
+import asyncio, functools, json, logging, sys, time, tracemalloc
+
+logging.basicConfig(level=logging.WARNING)
+
+import orm, encoder
+from apis import Page
+from config import configs
+from models import Blog, Comment
+
+BENCH_BLOG_ID = 'bench-blog'
+
+
+def make_comments(n):
+    return [Comment(blog_id=BENCH_BLOG_ID, user_id='bench-user', user_name='bench', user_image='about:blank',
+                    content='benchmark comment %s' % i, html_content='<p>benchmark comment %s</p>' % i) for i in range(n)]
+
+
+# 对比逐条save()和saveAll()插入n条评论的耗时
+async def bench_saveall(n=1000):
+    comments = make_comments(n)
+    start = time.time()
+    for c in comments:
+        await c.save()
+    t_save = time.time() - start
+    await Comment.deleteWhere('`blog_id`=?', [BENCH_BLOG_ID])
+
+    comments = make_comments(n)
+    start = time.time()
+    affected = await Comment.saveAll(comments)
+    t_saveall = time.time() - start
+    await Comment.deleteWhere('`blog_id`=?', [BENCH_BLOG_ID])
+
+    print('insert %s rows:' % n)
+    print('  save() loop: %.3fs (%.0f rows/s)' % (t_save, n / t_save))
+    print('  saveAll():   %.3fs (%.0f rows/s), batches: %s' % (t_saveall, n / t_saveall, affected))
+
+
+# 旧版findAll：每次调用都重新拼接SQL，再对整条SQL做replace
+async def legacy_findall(cls, where=None, args=None, **kw):
+    sql = [cls.__select__]
+    if where:
+        sql.append('where')
+        sql.append(where)
+    if args is None:
+        args = []
+    orderBy = kw.get('orderBy', None)
+    if orderBy:
+        sql.append('order by')
+        sql.append(orderBy)
+    limit = kw.get('limit', None)
+    if limit is not None:
+        sql.append('limit')
+        if isinstance(limit, int):
+            sql.append('?')
+            args.append(limit)
+        elif isinstance(limit, tuple) and len(limit) == 2:
+            sql.append('?, ?')
+            args.extend(limit)
+    rs = await legacy_select(' '.join(sql).replace('?', '%s'), args)
+    return [cls(**r) for r in rs]
+
+
+async def legacy_select(sql, args, size=None):
+    return []
+
+
+# 对比findAll调用本身（拼SQL + 占位符转换）的开销，用不访问数据库的select代替真实查询
+async def bench_findall(n=100000):
+    async def fake_select(sql, args, size=None):
+        orm.compile_sql(sql)
+        return []
+    orm.select = fake_select
+
+    async def run(find):
+        start = time.time()
+        for i in range(n):
+            await find('user_id=?', ['u'], orderBy='created_at desc', limit=(i, 10))
+        return time.time() - start
+
+    # 各跑5轮取最好成绩，减少噪声
+    t_before = min([await run(functools.partial(legacy_findall, Blog)) for i in range(5)])
+    t_after = min([await run(Blog.findAll) for i in range(5)])
+
+    print('findAll call overhead, %s calls:' % n)
+    print('  before (rebuild + replace): %.2fus/call' % (t_before * 1e6 / n))
+    print('  after (compiled cache):     %.2fus/call' % (t_after * 1e6 / n))
+    print('  sql cache: %s' % (orm.compile_sql.cache_info(),))
+
+
+# 对比Model(dict)和紧凑行对象(__row__)在构造、属性访问、JSON序列化上的速度和内存占用
+async def bench_rows(n=100000):
+    columns = Blog.__row__.__columns__
+    tuples = [('%050d' % i, 'user', 'name', 'about:blank', 'title %s' % i, 'summary', 'content %s' % i, '<p>content</p>', 1.5e9 + i) for i in range(n)]
+
+    def build_models():
+        # DictCursor先为每行构造dict，再由cls(**r)复制一次
+        return [Blog(**dict(zip(columns, t))) for t in tuples]
+
+    def build_rows():
+        row = Blog.__row__
+        return [row(*t) for t in tuples]
+
+    for label, build in (('Model (dict)', build_models), ('compact row', build_rows)):
+        start = time.time()
+        objs = build()
+        t_build = time.time() - start
+        del objs
+        tracemalloc.start()
+        objs = build()
+        mem = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        start = time.time()
+        for o in objs:
+            o.name, o.created_at, o.user_name
+        t_attr = time.time() - start
+        start = time.time()
+        json.dumps(objs, ensure_ascii=False, default=lambda o: o.__dict__)
+        t_json = time.time() - start
+        print('%-13s build %.3fs, 3 attrs/row %.3fs, json %.3fs, memory %.1f bytes/row' % (label, t_build, t_attr, t_json, mem / n))
+        del objs
+
+
+# /api/blogs形状的响应：dict(page=Page, blogs=[...])，对比原来的json.dumps(default=o.__dict__)与encoder.dumps
+async def bench_json(n=2000):
+    def make_blogs(compact):
+        tuples = [('%050d' % i, 'user', '作者', 'about:blank', '标题 %s' % i, '摘要' * 20, '正文' * 200, '<p>%s</p>' % ('正文' * 200), 1.5e9 + i) for i in range(8)]
+        if compact:
+            return [Blog.__row__(*t) for t in tuples]
+        return [Blog(**dict(zip(Blog.__row__.__columns__, t))) for t in tuples]
+
+    def legacy_dumps(r):
+        return json.dumps(r, ensure_ascii=False, default=lambda o: o.__dict__).encode('utf-8')
+
+    backends = [n for n in ('orjson', 'ujson', 'json') if encoder._BACKENDS[n][0] is not None]
+    print('%s x /api/blogs payload (8 blogs):' % n)
+    for compact in (False, True):
+        payload = dict(page=Page(1000, 3), blogs=make_blogs(compact))
+        label = 'compact rows' if compact else 'Model dicts'
+        start = time.time()
+        for i in range(n):
+            legacy_dumps(payload)
+        print('  %-12s legacy json.dumps: %.1fus' % (label, (time.time() - start) * 1e6 / n))
+        for b in backends:
+            encoder.use_backend(b)
+            start = time.time()
+            for i in range(n):
+                encoder.dumps(payload)
+            print('  %-12s encoder[%s]: %.1fus' % (label, b, (time.time() - start) * 1e6 / n))
+    encoder.use_backend()
+
+
+# 原来RequestHandler.__call__里每个请求都重新判断参数类型、用parse_qs解析query的写法，用于和预编译的绑定函数对比
+async def legacy_bind(handler, request):
+    from urllib import parse
+    kw = None
+    if handler._has_var_kw_arg or handler._has_named_kw_args or handler._required_kw_args:
+        if request.method == 'POST':
+            if not request.content_type:
+                return None
+            ct = request.content_type.lower()
+            if ct.startswith('application/json'):
+                params = await request.json()
+                if not isinstance(params, dict):
+                    return None
+                kw = params
+            elif ct.startswith('application/x-www-form-urlencoded') or ct.startswith('multipart/form-data'):
+                params = await request.post()
+                kw = dict(**params)
+            else:
+                return None
+        if request.method == 'GET':
+            qs = request.query_string
+            if qs:
+                kw = dict()
+                for k, v in parse.parse_qs(qs, True).items():
+                    kw[k] = v[0]
+    if kw is None:
+        kw = dict(**request.match_info)
+    else:
+        if not handler._has_var_kw_arg and handler._named_kw_args:
+            copy = dict()
+            for name in handler._named_kw_args:
+                if name in kw:
+                    copy[name] = kw[name]
+            kw = copy
+        for k, v in request.match_info.items():
+            kw[k] = v
+    if handler._has_request_arg:
+        kw['request'] = request
+    if handler._required_kw_args:
+        for name in handler._required_kw_args:
+            if not name in kw:
+                return None
+    return kw
+
+
+class FakeRequest(object):
+
+    def __init__(self, method, query_string='', match_info=None, body=None):
+        self.method = method
+        self.query_string = query_string
+        self.match_info = match_info or {}
+        self.content_type = 'application/json'
+        self._body = body
+        self._query = None
+
+    # 和aiohttp一样在第一次访问时才解析query_string，解析的开销算在计时之内
+    @property
+    def query(self):
+        if self._query is None:
+            from urllib import parse
+            self._query = dict(parse.parse_qsl(self.query_string, True))
+        return self._query
+
+    async def json(self):
+        return dict(self._body)
+
+
+# 对比每个请求的参数绑定开销：GET /api/blogs?page=2、GET /blog/{id}、POST /api/blogs/{id}
+async def bench_dispatch(n=100000):
+    from coroweb import RequestHandler
+
+    # 和handlers.py中对应URL函数签名相同
+    async def api_blogs(*, page='1', cursor=None):
+        pass
+
+    async def get_blog(id):
+        pass
+
+    async def api_update_blog(id, request, *, name, summary, content):
+        pass
+
+    cases = [
+        ('GET /api/blogs?page=2', api_blogs, lambda: FakeRequest('GET', 'page=2')),
+        ('GET /blog/{id}', get_blog, lambda: FakeRequest('GET', match_info={'id': '0' * 50})),
+        ('POST /api/blogs/{id}', api_update_blog,
+         lambda: FakeRequest('POST', match_info={'id': '0' * 50}, body=dict(name='n', summary='s', content='c'))),
+    ]
+    print('%s x argument binding:' % n)
+    for label, fn, make in cases:
+        handler = RequestHandler(None, fn)
+        requests = [make() for i in range(n)]
+        start = time.time()
+        for r in requests:
+            await legacy_bind(handler, r)
+        t_legacy = time.time() - start
+        requests = [make() for i in range(n)]
+        start = time.time()
+        for r in requests:
+            await handler._bind(r)
+        t_bind = time.time() - start
+        print('  %-22s legacy: %.2fus  compiled: %.2fus' % (label, t_legacy * 1e6 / n, t_bind * 1e6 / n))
+
+
+# 对比n条UPDATE各自提交（autocommit）与放在一个orm.transaction()里只提交一次的耗时
+async def bench_tx(n=1000):
+    comments = make_comments(n)
+    await Comment.saveAll(comments)
+    start = time.time()
+    for c in comments:
+        await Comment.updateWhere('`user_name`=?', '`id`=?', ['bench-autocommit', c.id])
+    t_auto = time.time() - start
+    start = time.time()
+    async with orm.transaction():
+        for c in comments:
+            await Comment.updateWhere('`user_name`=?', '`id`=?', ['bench-tx', c.id])
+    t_tx = time.time() - start
+    await Comment.deleteWhere('`blog_id`=?', [BENCH_BLOG_ID])
+    print('update %s rows:' % n)
+    print('  autocommit:    %.3fs (%.0f rows/s)' % (t_auto, n / t_auto))
+    print('  transaction(): %.3fs (%.0f rows/s)' % (t_tx, n / t_tx))
+
+
+# 搜索索引：n篇中文日志的建索引耗时、内存和查询延迟
+async def bench_search(n=5000):
+    import random, search
+    random.seed(1)
+    # 常用汉字随机组成的两字词，加上几个固定的技术词
+    chars = [chr(c) for c in range(0x4e00, 0x4e00 + 800)]
+    words = [random.choice(chars) + random.choice(chars) for i in range(3000)]
+    words.extend(['性能', '优化', '数据库', '缓存', 'Python', 'MySQL', '连接池'])
+    def text(k):
+        return '，'.join(''.join(random.choice(words) for j in range(3)) for i in range(k))
+    blogs = [Blog.__row__('%050d' % i, 'user', '作者', 'about:blank', text(2), text(10), text(300), '', 1.5e9 + i)
+             for i in range(n)]
+    start = time.time()
+    for b in blogs:
+        search.index_blog(b)
+    t_build = time.time() - start
+    print('index %s blogs: %.2fs (%.2fms/blog), %s' % (n, t_build, t_build * 1000 / n, search.stats()))
+    for q in ('性能', '数据库缓存', 'python 连接池', '不存在的词'):
+        start = time.time()
+        for i in range(100):
+            num, rs = search.search(q)
+        print('  %-16s %6s hits  %.2fms/query' % (q, num, (time.time() - start) * 10))
+
+
+# 渲染n次约8万字符（UTF-8编码约190KB）的markdown，对比在事件循环里直接执行和用executor执行时，事件循环最长被卡住多久
+async def bench_executor(n=20):
+    import markdown, executor
+    text = '\n\n'.join('## 标题 %s\n\n段落 **加粗** `code` [链接](http://example.com) %s\n\n- 列表\n- 列表' % (i, '正文' * 50)
+                         for i in range(500))
+
+    async def heartbeat(lags, stop):
+        while not stop.is_set():
+            start = time.time()
+            await asyncio.sleep(0.001)
+            lags.append(time.time() - start - 0.001)
+
+    print('%s x markdown of %s chars:' % (n, len(text)))
+    for kind, workers in (('inline', 0), ('thread', 4), ('process', 4)):
+        executor.setup(kind if workers else 'thread', max_workers=workers)
+        lags = []
+        stop = asyncio.Event()
+        beat = asyncio.ensure_future(heartbeat(lags, stop))
+        start = time.time()
+        await asyncio.gather(*[executor.run(markdown.markdown, text, size=len(text)) for i in range(n)])
+        elapsed = time.time() - start
+        stop.set()
+        await beat
+        print('  %-8s total %.2fs, event loop max stall %.1fms' % (kind, elapsed, max(lags + [0]) * 1000))
+    executor.shutdown()
+
+
+async def run_db(loop, coro):
+    await orm.create_pool(loop=loop, **configs.db)
+    await coro
+
+
+BENCHES = {
+    'saveall': lambda loop, *args: run_db(loop, bench_saveall(*map(int, args))),
+    'tx': lambda loop, *args: run_db(loop, bench_tx(*map(int, args))),
+    'findall': lambda loop, *args: bench_findall(*map(int, args)),
+    'rows': lambda loop, *args: bench_rows(*map(int, args)),
+    'json': lambda loop, *args: bench_json(*map(int, args)),
+    'dispatch': lambda loop, *args: bench_dispatch(*map(int, args)),
+    'search': lambda loop, *args: bench_search(*map(int, args)),
+    'executor': lambda loop, *args: bench_executor(*map(int, args)),
+}
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHES:
+        print('usage: python3 bench.py <%s> [args...]' % '|'.join(sorted(BENCHES)))
+        sys.exit(1)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(BENCHES[sys.argv[1]](loop, *sys.argv[2:]))
+    loop.close()
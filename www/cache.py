@@ -0,0 +1,199 @@
+# 进程内缓存：带TTL和容量上限的LRU缓存，以及整页响应缓存
+import asyncio, time
+
+from collections import OrderedDict
+
+from shared import Generations
+
+
+class LRUCache(object):
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl # 默认过期时间（秒），None表示永不过期
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict() # key ==> (value, expires_at)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING, count=False) is not _MISSING
+
+    def get(self, key, default=None, count=True):
+        item = self._data.get(key)
+        if item is not None:
+            value, expires_at = item
+            if expires_at is None or expires_at > time.time():
+                # 命中后移到队尾，队首就是最久没有使用的
+                self._data.move_to_end(key)
+                if count:
+                    self.hits += 1
+                return value
+            # 已经过期的直接丢掉
+            del self._data[key]
+        if count:
+            self.misses += 1
+        return default
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        if ttl is not None and ttl <= 0:
+            self._data.pop(key, None)
+            return
+        expires_at = None if ttl is None else time.time() + ttl
+        self._data[key] = (value, expires_at)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key, default=None):
+        item = self._data.pop(key, None)
+        return default if item is None else item[0]
+
+    # 按条件批量失效，predicate(key, value)返回True的项会被删除，返回删除的个数
+    def discard_if(self, predicate):
+        keys = [k for k, (v, _) in self._data.items() if predicate(k, v)]
+        for k in keys:
+            del self._data[k]
+        return len(keys)
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return dict(size=len(self._data), maxsize=self.maxsize, hits=self.hits, misses=self.misses,
+                    evictions=self.evictions, hit_rate=(self.hits / total) if total else 0.0)
+
+
+_MISSING = object()
+
+
+# 整页响应缓存：key = (path, query_string, variant)，保存最终编码好的body
+# 新鲜期(ttl)内直接命中；过期后的stale期内，只放一个请求去重新生成，其余请求继续拿旧内容（stale-while-revalidate）
+# 同一个key同时只允许一个请求去查库渲染，其他请求等它的结果，避免新文章发布时的瞬间流量打穿MySQL
+# 失效计数放在多进程共享的Generations里：任何一个worker失效了某个路径，其他worker下次命中时发现计数变了就不再使用本地的旧内容
+class PageCache(object):
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttl=60, stale_ttl=300):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.bytes = 0
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict() # key ==> (body, content_type, created_at, generation)
+        self._paths = dict() # path ==> set(key)，用于按路径失效
+        self._generations = Generations() # path或前缀 ==> 失效次数，也防止失效前开始的生成结果在失效后被写回
+        self._pending = dict() # key ==> 正在生成中的future
+
+    # 返回(entry, state)，state为'fresh'、'stale'或None
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            return None, None
+        if entry[3] != self.generation(key[0]):
+            # 已经被其他进程失效
+            self._remove(key)
+            return None, None
+        age = time.time() - entry[2]
+        if age < self.ttl:
+            self._data.move_to_end(key)
+            return entry, 'fresh'
+        if age < self.ttl + self.stale_ttl:
+            self._data.move_to_end(key)
+            return entry, 'stale'
+        self._remove(key)
+        return None, None
+
+    # 路径自身和它所在的各级前缀（如/blog/123的/和/blog/）的失效次数之和，任何一个失效都会让它变大
+    def generation(self, path):
+        g = self._generations
+        n = g.get(path)
+        i = path.find('/')
+        while i != -1:
+            n = n + g.get('prefix:' + path[:i + 1])
+            i = path.find('/', i + 1)
+        return n
+
+    # 路径自身和各级前缀中最近一次失效的时间，从未失效过时为0
+    def invalidated_at(self, path):
+        g = self._generations
+        t = g.bumped_at(path)
+        i = path.find('/')
+        while i != -1:
+            t = max(t, g.bumped_at('prefix:' + path[:i + 1]))
+            i = path.find('/', i + 1)
+        return t
+
+    # 保存成功时返回保存的entry，否则返回None
+    def put(self, key, body, content_type, generation):
+        path = key[0]
+        if generation != self.generation(path):
+            # 生成期间页面已经被失效过，结果不能再用
+            return None
+        if len(body) > self.max_bytes:
+            return None
+        if key in self._data:
+            self._remove(key)
+        entry = (body, content_type, time.time(), generation)
+        self._data[key] = entry
+        self._paths.setdefault(path, set()).add(key)
+        self.bytes = self.bytes + len(body)
+        while self.bytes > self.max_bytes:
+            self._remove(next(iter(self._data)))
+            self.evictions += 1
+        return entry if key in self._data else None
+
+    # 正在生成中的future，没有则返回None
+    def pending(self, key):
+        return self._pending.get(key)
+
+    # 登记由当前请求负责生成，返回给其他请求等待的future
+    def begin(self, key):
+        fut = asyncio.get_event_loop().create_future()
+        self._pending[key] = fut
+        return fut
+
+    def end(self, key, fut, entry):
+        if self._pending.get(key) is fut:
+            del self._pending[key]
+        if not fut.done():
+            fut.set_result(entry)
+
+    def invalidate(self, path):
+        self._generations.bump(path)
+        for key in list(self._paths.get(path, ())):
+            self._remove(key)
+
+    # prefix必须以/结尾，如/blog/
+    def invalidate_prefix(self, prefix):
+        if not prefix.endswith('/'):
+            raise ValueError('Prefix must end with /: %s' % prefix)
+        self._generations.bump('prefix:' + prefix)
+        for path in [p for p in self._paths if p.startswith(prefix)]:
+            for key in list(self._paths[path]):
+                self._remove(key)
+
+    def clear(self):
+        self.invalidate_prefix('/')
+
+    def _remove(self, key):
+        entry = self._data.pop(key)
+        self.bytes = self.bytes - len(entry[0])
+        keys = self._paths.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._paths[key[0]]
+
+    def stats(self):
+        return dict(size=len(self._data), bytes=self.bytes, max_bytes=self.max_bytes, hits=self.hits,
+                    stale_hits=self.stale_hits, misses=self.misses, evictions=self.evictions)
@@ -7,9 +7,60 @@ configs = {
         'port': 3306,
         'user': 'www-data',
         'password': 'www-data',
-        'db': 'awesome'
+        'db': 'awesome',
+        'minsize': 1,
+        'maxsize': 10, # 每个worker进程各自的连接池大小
+        'replicas': [], # 只读从库，如[{'host': '10.0.0.2'}]，未写出的配置与主库相同
+        'replica_policy': 'round_robin', # 从库选择方式：round_robin/least_busy
+        'replica_retry': 30, # 从库出错后暂停使用的秒数
+        'pin_seconds': 5, # 写过数据库的客户端在之后这么多秒内读主库
+        'slow_query': 0.5 # 超过这么多秒的SQL记入慢查询日志
+    },
+    'logging': {
+        'level': 'INFO',
+        'sql_sample_rate': 0.01 # DEBUG级别下SQL日志的采样比例
+    },
+    'server': {
+        'host': '127.0.0.1',
+        'port': 9000,
+        'backlog': 128,
+        'workers': 1, # 大于1时以prefork方式启动多个worker进程，也可以用--workers指定
+        'metrics_port': 9100 # 多进程时第i个worker（从0开始）在metrics_port+i上单独提供/metrics
+    },
+    'templates': {
+        'cache_dir': None, # 生产模式（debug=False）下模板字节码的缓存目录，None表示使用系统临时目录
+        'streaming': True # 使用jinja2异步模式流式输出页面
+    },
+    'json': {
+        'backend': 'auto' # auto/orjson/ujson/json
+    },
+    'orm': {
+        'count_reconcile': 300 # 内存行数与数据库校准的间隔（秒）
+    },
+    'executor': {
+        'kind': 'thread', # thread/process：markdown渲染、摘要计算等CPU密集调用使用的池，模板渲染总是使用线程
+        'max_workers': 4, # 每个worker进程的池大小，0表示全部在事件循环里执行
+        'max_pending': 256, # 同时排队和执行的任务数上限，超过时调用方等待
+        'inline_bytes': 4096 # 输入小于这么多字节/字符的直接执行
+    },
+    'comments': {
+        'page_size': 10 # 日志页直接渲染的评论条数，其余的由页面通过/api/blogs/{id}/comments按页加载
+    },
+    'search': {
+        'rebuild_interval': 0, # 从数据库整体重建搜索索引的间隔（秒），0表示只在启动时建一次（写操作已经增量更新）；索引在进程内，只适用于单进程部署
+        'page_size': 10
+    },
+    'markdown': {
+        'cache_size': 2000 # 按内容摘要缓存渲染结果的条数（用于旧数据的懒渲染）
+    },
+    'page_cache': {
+        'max_bytes': 64 * 1024 * 1024, # 整页缓存占用内存上限
+        'ttl': 60, # 新鲜期（秒）
+        'stale_ttl': 300 # 过期后仍可返回旧内容的时间（秒），期间后台只有一个请求去重新生成
     },
     'session': {
-        'secret': 'Awesome'
+        'secret': 'Awesome',
+        'cache_size': 10000, # 已验证用户的缓存条数
+        'cache_ttl': 600 # 缓存过期时间（秒），同时不会超过cookie本身的过期时间
     }
 }
\ No newline at end of file
@@ -11,7 +11,6 @@
 
 import asyncio, os, inspect, logging, functools
 
-from urllib import parse
 
 from aiohttp import web
 
@@ -46,6 +45,12 @@ def post(path):
     return decorator
 
 
+# 编写装饰函数@cache_page，标记该URL的整页响应可以被缓存（需写在@get()之上）
+def cache_page(func):
+    func.__cache_page__ = True
+    return func
+
+
 # URL处理函数不一定是一个协程，因此我们用RequestHandler()来封装一个URL处理函数
 # 以下是RequestHandler需要定义的一些函数
 def get_required_kw_args(fn):
@@ -93,6 +98,30 @@ def has_request_arg(fn):
     return found
 
 
+# 解析POST请求体，结果保存在request.__data__上，同一个请求只解析一次（data_factory和RequestHandler共用）
+# 返回dict/MultiDict，请求不合法时返回web.HTTPBadRequest
+async def read_body(request):
+    data = getattr(request, '__data__', None)
+    if data is not None:
+        return data
+    # 判断content_type是否为空
+    if not request.content_type:
+        return web.HTTPBadRequest(text='Missing Content-Type.')
+    ct = request.content_type.lower()
+    # startsWith()方法用来判断当前字符串是否是以另外一个给定的子字符串“开头”的
+    if ct.startswith('application/json'):
+        # 请求json数据
+        data = await request.json()
+        if not isinstance(data, dict):
+            return web.HTTPBadRequest(text='JSON body must be object.')
+    elif ct.startswith('application/x-www-form-urlencoded') or ct.startswith('multipart/form-data'):
+        data = await request.post()
+    else:
+        return web.HTTPBadRequest(text='Unsupported Content-Type: %s' % request.content_type)
+    request.__data__ = data
+    return data
+
+
 # RequestHandler目的就是从URL函数中分析其需要接收的参数，从request中获取必要的参数，再调用URL函数，然后把结果转换为web.Response对象，这样，就完全符合aiohttp框架的要求
 class RequestHandler(object):
 
@@ -104,57 +133,64 @@ class RequestHandler(object):
         self._has_named_kw_args = has_named_kw_args(fn)
         self._named_kw_args = get_named_kw_args(fn)
         self._required_kw_args = get_required_kw_args(fn)
+        self._cache_page = getattr(fn, '__cache_page__', False)
+        self._bind = self._compile_binder()
 
-    # 使得其实例变成可调用函数
-    async def __call__(self, request):
-        kw = None
-        if self._has_var_kw_arg or self._has_named_kw_args or self._required_kw_args:
-            if request.method == 'POST':
-                # 判断content_type是否为空
-                if not request.content_type:
-                    return web.HTTPBadRequest(text='Missing Content-Type.')
-                ct = request.content_type.lower()
-                # startsWith()方法用来判断当前字符串是否是以另外一个给定的子字符串“开头”的
-                if ct.startswith('application/json'):
-                    # 请求json数据
-                    params = await request.json()
-                    if not isinstance(params, dict):
-                        return web.HTTPBadRequest(text='JSON body must be object.')
-                    kw = params
-                elif ct.startswith('application/x-www-form-urlencoded') or ct.startswith('multipart/form-data'):
-                    params = await request.post()
-                    kw = dict(**params)
-                else:
-                    return web.HTTPBadRequest(text='Unsupported Content-Type: %s' % request.content_type)
-            if request.method == 'GET':
-                qs = request.query_string
-                if qs:
-                    kw = dict()
-                    for k, v in parse.parse_qs(qs, True).items():
-                        kw[k] = v[0]
-        if kw is None:
-            kw = dict(**request.match_info)
+    # 注册路由时就根据URL函数的签名生成专用的参数绑定函数，每个请求只做该函数需要的那部分工作
+    # 绑定函数返回参数dict，参数不合法时返回web.HTTPBadRequest
+    def _compile_binder(self):
+        has_request_arg = self._has_request_arg
+        required = self._required_kw_args
+        named = self._named_kw_args
+
+        if not (self._has_var_kw_arg or self._has_named_kw_args or required):
+            # 只需要URL中的参数
+            async def bind_match_info(request):
+                kw = dict(request.match_info)
+                if has_request_arg:
+                    kw['request'] = request
+                return kw
+            return bind_match_info
+
+        # 从query或请求体中取参数：有**kw时全部保留（同名取第一个值），否则只取命名关键字参数
+        if self._has_var_kw_arg or not named:
+            def pick(data):
+                return {k: data[k] for k in data}
         else:
-            if not self._has_var_kw_arg and self._named_kw_args:
-                # 移除所有unnamed kw:
-                copy = dict()
-                for name in self._named_kw_args:
-                    if name in kw:
-                        copy[name] = kw[name]
-                kw = copy
+            def pick(data):
+                return {name: data[name] for name in named if name in data}
+
+        async def bind(request):
+            method = request.method
+            if method == 'GET':
+                kw = pick(request.query)
+            elif method == 'POST':
+                data = await read_body(request)
+                if isinstance(data, web.StreamResponse):
+                    return data
+                kw = pick(data)
+            else:
+                kw = dict()
             # check named arg:
             for k, v in request.match_info.items():
                 if k in kw:
                     logging.warning('Duplicate arg name in named arg and kw args: %s' % k)
                 kw[k] = v
-        if self._has_request_arg:
-            kw['request'] = request
-        # check required kw:
-        if self._required_kw_args:
-            for name in self._required_kw_args:
+            if has_request_arg:
+                kw['request'] = request
+            # check required kw:
+            for name in required:
                 if not name in kw:
                     return web.HTTPBadRequest(text='Missing argument: %s' % name)
-        logging.info('call with args: %s' % str(kw))
+            return kw
+        return bind
+
+    # 使得其实例变成可调用函数
+    async def __call__(self, request):
+        kw = await self._bind(request)
+        if not isinstance(kw, dict):
+            return kw
+        logging.debug('call with args: %s', kw)
         try:
             r = await self._func(**kw)
             return r
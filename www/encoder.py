@@ -0,0 +1,77 @@
+# API响应的JSON编码：所有输出JSON的地方都通过dumps()序列化，返回utf-8编码的bytes
+# 安装了orjson或ujson时自动使用，否则使用标准库json
+import json, logging
+
+from orm import Row
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+    # 老版本的ujson不支持default参数
+    ujson.dumps(object(), default=str)
+except (ImportError, TypeError):
+    ujson = None
+
+
+# 按类型缓存的转换函数：type ==> fn(obj)，dict/list等原生类型由后端直接处理，不会走到这里
+_converters = dict()
+
+
+def _converter(cls):
+    if issubclass(cls, Row):
+        # 紧凑行对象使用元类根据__mappings__预先生成的_asdict
+        return cls._asdict
+    return vars
+
+
+def _default(o):
+    fn = _converters.get(type(o))
+    if fn is None:
+        fn = _converters[type(o)] = _converter(type(o))
+    try:
+        return fn(o)
+    except TypeError:
+        raise TypeError('Object of type %s is not JSON serializable' % type(o).__name__)
+
+
+def _dumps_orjson(obj):
+    return orjson.dumps(obj, default=_default)
+
+
+def _dumps_ujson(obj):
+    return ujson.dumps(obj, ensure_ascii=False, default=_default).encode('utf-8')
+
+
+_json_encoder = json.JSONEncoder(ensure_ascii=False, default=_default)
+
+
+def _dumps_json(obj):
+    return _json_encoder.encode(obj).encode('utf-8')
+
+
+_BACKENDS = dict(orjson=(orjson, _dumps_orjson), ujson=(ujson, _dumps_ujson), json=(json, _dumps_json))
+
+backend = None
+dumps = None
+
+
+# 选择序列化后端：'auto'按orjson、ujson、json的顺序选第一个可用的
+def use_backend(name='auto'):
+    global backend, dumps
+    names = ('orjson', 'ujson', 'json') if name == 'auto' else (name, )
+    for n in names:
+        if n not in _BACKENDS:
+            raise ValueError('Unknown JSON backend: %s' % n)
+        mod, fn = _BACKENDS[n]
+        if mod is not None:
+            backend, dumps = n, fn
+            logging.info('use JSON backend: %s' % n)
+            return n
+    raise ValueError('JSON backend not installed: %s' % name)
+
+
+use_backend()
@@ -0,0 +1,103 @@
+# CPU密集的同步调用（markdown渲染、模板渲染）放到线程池或进程池里执行，不占用事件循环
+# 输入小于inline_bytes的直接在当前线程执行，提交到池里的开销比执行本身还大
+# 同时在执行和排队的任务数不超过max_pending，超过时调用方等待，防止任务无限堆积
+import asyncio, time, logging
+
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import metrics
+from metrics import Histogram, HistogramFamily
+
+_kind = None
+_pool = None # 按配置创建的线程池或进程池
+_threads = None # 参数无法pickle的任务（如模板渲染）使用的线程池，kind为thread时就是_pool
+_slots = None
+_max_pending = 0
+INLINE_BYTES = 4096
+
+_pending = 0
+_inline_total = 0
+_offload_total = 0
+_queue_wait = Histogram()
+_task_duration = HistogramFamily()
+
+
+# 在worker进程里创建（prefork时每个worker各有一个池），kind为thread/process，max_workers为0时全部在事件循环里执行
+def setup(kind='thread', max_workers=4, max_pending=256, inline_bytes=4096):
+    global _kind, _pool, _threads, _slots, _max_pending, INLINE_BYTES
+    shutdown()
+    if kind not in ('thread', 'process'):
+        raise ValueError('Invalid executor kind: %s' % kind)
+    INLINE_BYTES = inline_bytes
+    if not max_workers:
+        return
+    _kind = kind
+    if kind == 'process':
+        _pool = ProcessPoolExecutor(max_workers)
+        _threads = ThreadPoolExecutor(max_workers, thread_name_prefix='cpu')
+    else:
+        _pool = _threads = ThreadPoolExecutor(max_workers, thread_name_prefix='cpu')
+    _max_pending = max_pending
+    _slots = asyncio.Semaphore(max_pending)
+    logging.info('executor: %s pool, %s workers, max pending %s, inline below %s bytes' % (kind, max_workers, max_pending, inline_bytes))
+
+
+def shutdown():
+    global _kind, _pool, _threads, _slots
+    for pool in set(p for p in (_pool, _threads) if p is not None):
+        pool.shutdown(wait=False)
+    _kind = _pool = _threads = _slots = None
+
+
+# 执行fn(*args)并返回结果，size是输入的大小（字节或字符数），为None时总是提交到池里
+# 进程池模式下fn和参数必须能pickle，否则用run_local
+async def run(fn, *args, size=None):
+    return (await _submit(_pool, fn, args, size))
+
+
+# 只能在本进程执行的任务（参数是模板、Model等对象），总是使用线程池
+async def run_local(fn, *args, size=None):
+    return (await _submit(_threads, fn, args, size))
+
+
+async def _submit(pool, fn, args, size):
+    global _pending, _inline_total, _offload_total
+    if pool is None or (size is not None and size < INLINE_BYTES):
+        _inline_total += 1
+        return fn(*args)
+    _offload_total += 1
+    _pending += 1
+    start = time.time()
+    try:
+        async with _slots:
+            _queue_wait.observe(time.time() - start)
+            started = time.time()
+            r = await asyncio.get_event_loop().run_in_executor(pool, fn, *args)
+            _task_duration.observe(getattr(fn, '__qualname__', repr(fn)), time.time() - started)
+            return r
+    finally:
+        _pending -= 1
+
+
+def stats():
+    return dict(kind=_kind, pending=_pending, max_pending=_max_pending, inline=_inline_total,
+                offloaded=_offload_total, inline_bytes=INLINE_BYTES)
+
+
+@metrics.register
+def _collect_metrics():
+    L = ['# HELP executor_pending_tasks Tasks queued or running in the CPU executor.',
+         '# TYPE executor_pending_tasks gauge',
+         'executor_pending_tasks %s' % _pending,
+         '# HELP executor_tasks_total CPU-bound calls by where they ran.',
+         '# TYPE executor_tasks_total counter',
+         'executor_tasks_total%s %s' % (metrics.format_labels([('mode', 'inline')]), _inline_total),
+         'executor_tasks_total%s %s' % (metrics.format_labels([('mode', 'offloaded')]), _offload_total),
+         '# HELP executor_queue_wait_seconds Time spent waiting for an executor slot.',
+         '# TYPE executor_queue_wait_seconds histogram']
+    L.extend(metrics.format_histogram('executor_queue_wait_seconds', [], _queue_wait))
+    L.append('# HELP executor_task_duration_seconds Time from handing a call to the pool until its result, by function.')
+    L.append('# TYPE executor_task_duration_seconds histogram')
+    for name, h in _task_duration.items():
+        L.extend(metrics.format_histogram('executor_task_duration_seconds', [('fn', name)], h))
+    return L
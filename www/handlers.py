@@ -2,19 +2,32 @@ from models import User
 from coroweb import get
 import asyncio
 
-import re, time, json, logging, hashlib, base64, asyncio
+import re, time, logging, hashlib, base64, asyncio
+from datetime import datetime
 # markdown 是处理日志文本的一种格式语法，具体语法使用请百度
 import markdown
 from aiohttp import web
-from coroweb import get, post
+from coroweb import get, post, cache_page
 # 分页管理以及调取API时的错误信息
-from apis import Page, APIValueError, APIResourceNotFoundError, APIPermissionError, APIError
+from apis import Page, CursorPage, encode_cursor, decode_cursor, APIValueError, APIResourceNotFoundError, APIPermissionError, APIError
 from models import User, Comment, Blog, next_id
 from config import configs
+import encoder, orm, metrics, search, executor
+from cache import LRUCache, PageCache
+from shared import Generations
 
 COOKIE_NAME = 'awesession' # 用来在set_cookie中命名
 _COOKIE_KEY = configs.session.secret # 导入默认设置
 
+# 已验证用户的缓存：cookie ==> user，避免每个请求都去数据库User.find一次
+_session_cache = LRUCache(configs.session.get('cache_size', 10000))
+# 用户id ==> 失效次数，多个worker共享；缓存的登录状态记下当时的计数，命中时计数变了就重新查库
+_user_generations = Generations()
+# markdown渲染结果缓存：sha1(content) ==> html
+_markdown_cache = LRUCache(configs.markdown.get('cache_size', 2000))
+# 整页缓存，由response_factory之前的page_cache_factory使用，写操作的handler负责失效
+page_cache = PageCache(**configs.page_cache)
+
 # API就是把Web App的功能全部封装了，所以，通过API操作数据，可以极大地把前端和后端的代码隔离，使得后端代码易于测试，前端代码编写更简单
 # 我们希望能直接通过一个@api来把函数变成JSON格式的REST API
 # 只要返回一个dict，后续的response这个middleware就可以把结果序列化为JSON并返回(在拦截器中定义了如果得到的是字典，则返回json文件)
@@ -32,6 +45,20 @@ async def api_get_users(*, page='1'):
         u.passwd = '******'
     return dict(page=p, users=users)
 
+# 时间转换，模板里的datetime过滤器；通过API返回的时间也用它格式化，保证两边显示一致
+def datetime_filter(t):
+    delta = int(time.time() - t)
+    if delta < 60 :
+        return u'1分钟前'
+    if delta < 3600 :
+        return u'%s分钟前' % (delta // 60)
+    if delta < 86400 :
+        return u'%s小时前' % (delta // 3600)
+    if delta < 604800 :
+        return u'%s天前' % (delta // 86400)
+    dt = datetime.fromtimestamp(t)
+    return u'%s年%s月%s日' % (dt.year, dt.month, dt.day)
+
 # 查看是否是管理员用户
 def check_admin(request):
     if request.__user__ is None or not request.__user__.admin:
@@ -48,6 +75,25 @@ def get_page_index(page_str):
         p = 1
     return p
 
+# 游标分页：cursor为空字符串时取第一页，返回(CursorPage, 结果列表)
+# count为False时不查总数（item_count为None），只需要has_next的地方可以省掉一次count查询
+async def get_cursor_page(model, cursor, where=None, args=None, page_size=8, compact=True, count=True):
+    direction, key = decode_cursor(cursor)
+    num = await model.findNumber('count(id)', where, args) if count else None
+    if direction == 'p':
+        items = await model.findByCursor(where, args, before=key, limit=page_size + 1, compact=compact)
+        has_previous = len(items) > page_size
+        items = items[-page_size:]
+        has_next = True
+    else:
+        items = await model.findByCursor(where, args, after=key, limit=page_size + 1, compact=compact)
+        has_next = len(items) > page_size
+        items = items[:page_size]
+        has_previous = key is not None
+    next = encode_cursor('n', items[-1].created_at, items[-1].id) if has_next and items else None
+    prev = encode_cursor('p', items[0].created_at, items[0].id) if has_previous and items else None
+    return CursorPage(num, page_size, next, prev), items
+
 # 计算加密cookie
 def user2cookie(user, max_age):
     # build cookie string by: id-expires-sha1（id-到期时间-摘要算法）
@@ -61,6 +107,21 @@ def text2html(text):
     lines = map(lambda s: '<p>%s</p>' % s.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;'), filter(lambda s: s.strip() != '', text.split('\n')))
     return ''.join(lines)
 
+# markdown转HTML，相同内容只渲染一次，长文本的渲染放到executor里执行
+async def markdown_html(content):
+    key = hashlib.sha1(content.encode('utf-8')).hexdigest()
+    html = _markdown_cache.get(key)
+    if html is None:
+        html = await executor.run(markdown.markdown, content, size=len(content))
+        _markdown_cache.set(key, html)
+    return html
+
+# 没有预渲染结果的旧数据，在读取时再懒渲染
+async def ensure_html(obj):
+    if not obj.html_content:
+        obj.html_content = await markdown_html(obj.content)
+    return obj
+
 # 解密cookie
 async def cookie2user(cookie_str):
     if not cookie_str:
@@ -70,8 +131,16 @@ async def cookie2user(cookie_str):
         if len(L) != 3:
             return None
         uid, expires, sha1 = L
-        if int(expires) < time.time():
+        now = time.time()
+        if int(expires) < now:
             return None
+        generation = _user_generations.get(uid)
+        item = _session_cache.get(cookie_str)
+        if item is not None:
+            if item[1] == generation:
+                return item[0]
+            # 该用户已在某个worker里被失效
+            _session_cache.pop(cookie_str)
         user = await User.find(uid)
         if user is None:
             return None
@@ -80,12 +149,21 @@ async def cookie2user(cookie_str):
             logging.info('invalid sha1')
             return None
         user.passwd = '******'
+        # 缓存时间不超过cookie的过期时间
+        _session_cache.set(cookie_str, (user, generation), min(configs.session.get('cache_ttl', 600), int(expires) - now))
         return user
     except Exception as e:
         logging.exception(e)
         return None
 
+# 用户被删除、密码或管理员标记变化时，必须调用此函数让其已缓存的登录状态失效，其他worker在下次命中时失效
+def invalidate_user(uid):
+    _user_generations.bump(uid)
+    prefix = '%s-' % uid
+    return _session_cache.discard_if(lambda k, v: k.startswith(prefix))
+
 # 处理首页URL
+@cache_page
 @get('/')
 async def index(*, page='1'):
     page_index = get_page_index(page)
@@ -95,7 +173,7 @@ async def index(*, page='1'):
     if num == 0:
         blogs = []
     else:
-        blogs = await Blog.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+        blogs = await Blog.findAll(orderBy='created_at desc', limit=(p.offset, p.limit), compact=True)
     return {
         '__template__': 'blogs.html',
         'page': p,
@@ -103,17 +181,20 @@ async def index(*, page='1'):
     }
 
 # 处理日志详情页面URL
+@cache_page
 @get('/blog/{id}')
 async def get_blog(id):
     blog = await Blog.find(id)
-    comments = await Comment.findAll('blog_id=?', [id], orderBy='created_at desc')
+    # 只渲染最新的一页评论，更早的评论由页面按游标加载
+    p, comments = await get_cursor_page(Comment, '', '`blog_id`=?', [id], page_size=configs.comments.page_size, count=False)
     for c in comments:
-        c.html_content = markdown.markdown(c.content)
-    blog.html_content = markdown.markdown(blog.content)
+        await ensure_html(c)
+    await ensure_html(blog)
     return {
         '__template__': 'blog.html',
         'blog': blog,
-        'comments': comments
+        'comments': comments,
+        'comment_page': p
     }
 
 # 处理注册页面URL
@@ -153,7 +234,7 @@ async def authenticate(*, email, passwd):
     r.set_cookie(COOKIE_NAME, user2cookie(user, 86400), max_age=86400, httponly=True)
     user.passwd = '******'
     r.content_type = 'application/json'
-    r.body = json.dumps(user, ensure_ascii=False).encode('utf-8')
+    r.body = encoder.dumps(user)
     return r
 
 # 用户注销
@@ -213,14 +294,28 @@ def manage_users(*, page='1'):
     }
 
 # 获取评论信息API
+# 传入cursor参数（可以为空）时改用游标分页，返回的page中带next/prev游标
 @get('/api/comments')
-async def api_comments(*, page='1'):
+async def api_comments(*, page='1', cursor=None):
+    if cursor is not None:
+        p, comments = await get_cursor_page(Comment, cursor)
+        return dict(page=p, comments=comments)
     page_index = get_page_index(page)
     num = await Comment.findNumber('count(id)')
     p = Page(num, page_index)
     if num == 0:
         return dict(page=p, comments=())
-    comments = await Comment.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+    comments = await Comment.findAll(orderBy='created_at desc', limit=(p.offset, p.limit), compact=True)
+    return dict(page=p, comments=comments)
+
+# 某篇日志的评论API，按游标分页，最新的在前
+@get('/api/blogs/{id}/comments')
+async def api_blog_comments(id, *, cursor=''):
+    p, comments = await get_cursor_page(Comment, cursor, '`blog_id`=?', [id], page_size=configs.comments.page_size, count=False)
+    for c in comments:
+        await ensure_html(c)
+    # created_at_text与页面上datetime过滤器的显示相同
+    comments = [dict(c._asdict(), created_at_text=datetime_filter(c.created_at)) for c in comments]
     return dict(page=p, comments=comments)
 
 # 用户发表评论API
@@ -234,8 +329,11 @@ async def api_create_comment(id, request, *, content):
     blog = await Blog.find(id)
     if blog is None:
         raise APIResourceNotFoundError('Blog')
-    comment = Comment(blog_id=blog.id, user_id=user.id, user_name=user.name, user_image=user.image, content=content.strip())
+    content = content.strip()
+    comment = Comment(blog_id=blog.id, user_id=user.id, user_name=user.name, user_image=user.image, content=content, html_content=await markdown_html(content))
     await comment.save()
+    page_cache.invalidate('/blog/%s' % blog.id)
+    search.index_comment(comment)
     return comment
 
 # 管理员删除评论API
@@ -246,21 +344,54 @@ async def api_delete_comments(id, request):
     if c is None:
         raise APIResourceNotFoundError('Comment')
     await c.remove()
+    page_cache.invalidate('/blog/%s' % c.blog_id)
+    search.remove('comment', id)
     return dict(id=id)
 
 # 获取用户信息API
 @get('/api/users')
-async def api_get_users(*, page='1'):
+async def api_get_users(*, page='1', cursor=None):
+    if cursor is not None:
+        p, users = await get_cursor_page(User, cursor)
+        for u in users:
+            u.passwd = '******'
+        return dict(page=p, users=users)
     page_index = get_page_index(page)
     num = await User.findNumber('count(id)')
     p = Page(num, page_index)
     if num == 0:
         return dict(page=p, users=())
-    users = await User.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+    users = await User.findAll(orderBy='created_at desc', limit=(p.offset, p.limit), compact=True)
     for u in users:
         u.passwd = '******'
     return dict(page=p, users=users)
 
+# 缓存命中统计API
+@get('/api/caches')
+def api_caches(request):
+    check_admin(request)
+    return dict(session=_session_cache.stats(), markdown=_markdown_cache.stats(), page=page_cache.stats(), search=search.stats(),
+                executor=executor.stats())
+
+# 数据库连接池和SQL耗时统计API
+@get('/api/db/stats')
+def api_db_stats(request):
+    check_admin(request)
+    return orm.stats()
+
+# Prometheus指标，只允许本机直接访问（经nginx转发的请求带X-Real-IP头）或管理员访问
+@get('/metrics')
+def prometheus_metrics(request):
+    local = request.remote in ('127.0.0.1', '::1') and 'X-Real-IP' not in request.headers and 'X-Forwarded-For' not in request.headers
+    if not local:
+        check_admin(request)
+    if metrics.worker_port is not None:
+        # 多进程时这里只能随机落到某一个worker上，要分别抓取每个worker自己的端口
+        return web.HTTPNotFound(text='Metrics are served per worker on port %s + worker index.' % metrics.worker_port)
+    r = web.Response(body=metrics.render().encode('utf-8'))
+    r.headers['Content-Type'] = metrics.CONTENT_TYPE
+    return r
+
 # 定义EMAIL和HASH的格式规范（正则表达式）
 _RE_EMAIL = re.compile(r'^[a-z0-9\.\-\_]+\@[a-z0-9\-\_]+(\.[a-z0-9\-\_]+){1,4}$')
 _RE_SHA1 = re.compile(r'^[0-9a-f]{40}$')
@@ -290,18 +421,21 @@ async def api_register_user(*, email, name, passwd):
     r.set_cookie(COOKIE_NAME, user2cookie(user, 86400), max_age=86400, httponly=True)
     user.passwd = '******'
     r.content_type = 'application/json'
-    r.body = json.dumps(user, ensure_ascii=False).encode('utf-8')
+    r.body = encoder.dumps(user)
     return r
 
 # 获取日志列表API
 @get('/api/blogs')
-async def api_blogs(*, page='1'):
+async def api_blogs(*, page='1', cursor=None):
+    if cursor is not None:
+        p, blogs = await get_cursor_page(Blog, cursor)
+        return dict(page=p, blogs=blogs)
     page_index = get_page_index(page)
     num = await Blog.findNumber('count(id)')
     p = Page(num, page_index)
     if num == 0:
         return dict(page=p, blogs=())
-    blogs = await Blog.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+    blogs = await Blog.findAll(orderBy='created_at desc', limit=(p.offset, p.limit), compact=True)
     return dict(page=p, blogs=blogs)
 
 # 获取日志详情API
@@ -310,6 +444,32 @@ async def api_get_blog(*, id):
     blog = await Blog.find(id)
     return blog
 
+# 全文搜索API：q为搜索词，type可选blog/comment，结果按相关度排序
+@get('/api/search')
+def api_search(*, q, type=None, page='1'):
+    if not q or not q.strip():
+        raise APIValueError('q', 'q cannot be empty.')
+    if type not in (None, '', 'blog', 'comment'):
+        raise APIValueError('type', 'type must be blog or comment.')
+    page_index = get_page_index(page)
+    page_size = configs.search.page_size
+    num, rs = search.search(q, type or None, page_size * (page_index - 1), page_size)
+    p = Page(num, page_index, page_size)
+    results = [dict(meta, type=kind, id=id, score=round(score, 4)) for score, kind, id, meta in rs]
+    return dict(page=p, results=results)
+
+# 导出全部日志API，返回异步迭代器，由response_factory流式输出为JSON数组
+@get('/api/export/blogs')
+def api_export_blogs(request):
+    check_admin(request)
+    return Blog.iterAll(orderBy='created_at desc', compact=True)
+
+# 导出全部评论API
+@get('/api/export/comments')
+def api_export_comments(request):
+    check_admin(request)
+    return Comment.iterAll(orderBy='created_at desc', compact=True)
+
 # 发表日志API
 @post('/api/blogs')
 async def api_create_blog(request, *, name, summary, content):
@@ -321,8 +481,11 @@ async def api_create_blog(request, *, name, summary, content):
         raise APIValueError('summary', 'summary cannot be empty.')
     if not content or not content.strip():
         raise APIValueError('content', 'content cannot be empty.')
-    blog = Blog(user_id=request.__user__.id, user_name=request.__user__.name, user_image=request.__user__.image, name=name.strip(), summary=summary.strip(), content=content.strip())
+    content = content.strip()
+    blog = Blog(user_id=request.__user__.id, user_name=request.__user__.name, user_image=request.__user__.image, name=name.strip(), summary=summary.strip(), content=content, html_content=await markdown_html(content))
     await blog.save()
+    page_cache.invalidate('/')
+    search.index_blog(blog)
     return blog
 
 # 编辑日志API
@@ -339,7 +502,11 @@ async def api_update_blog(id, request, *, name, summary, content):
     blog.name = name.strip()
     blog.summary = summary.strip()
     blog.content = content.strip()
+    blog.html_content = await markdown_html(blog.content)
     await blog.update()
+    page_cache.invalidate('/')
+    page_cache.invalidate('/blog/%s' % id)
+    search.index_blog(blog)
     return blog
 
 # 删除日志API
@@ -348,24 +515,24 @@ async def api_delete_blog(request, *, id):
     check_admin(request)
     blog = await Blog.find(id)
     await blog.remove()
+    page_cache.invalidate('/')
+    page_cache.invalidate('/blog/%s' % id)
+    search.remove('blog', id)
     return dict(id=id)
 
 # 删除用户API
 @post('/api/users/{id}/delete')
 async def api_delete_users(id, request):
     check_admin(request)
-    id_buff = id
     user = await User.find(id)
     if user is None:
         raise APIResourceNotFoundError('Comment')
-    await user.remove()
-    # 给被删除的用户在评论中标记
-    comments = await Comment.findAll('user_id=?',[id])
-    if comments:
-        for comment in comments:
-            id = comment.id
-            c = await Comment.find(id)
-            c.user_name = c.user_name + ' (该用户已被删除)'
-            await c.update()
-    id = id_buff
+    # 删除用户和标记评论在同一个事务里，只提交一次
+    async with orm.transaction():
+        await user.remove()
+        # 给被删除的用户在评论中标记，一条UPDATE语句完成，不管该用户有多少评论
+        await Comment.updateWhere('`user_name`=concat(`user_name`, ?)', '`user_id`=?', [' (该用户已被删除)', id])
+    invalidate_user(id)
+    # 评论里的用户名变了，所有日志页都要重新生成
+    page_cache.invalidate_prefix('/blog/')
     return dict(id=id)
\ No newline at end of file
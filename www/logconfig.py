@@ -0,0 +1,47 @@
+# 日志配置：格式化之后的写出放到后台线程（QueueHandler + QueueListener），
+# 处理请求的事件循环线程只负责把日志记录放进队列，不会因为写stdout/supervisor日志文件而阻塞
+import logging, logging.handlers, queue, os, sys, atexit
+
+_listener = None
+
+
+# 每个进程各调用一次（多进程模式下fork之后子进程要重新调用，后台线程不会被fork继承）
+# background=False时直接同步写出，用于prefork的master：master里不能有后台线程，否则fork时线程可能正持有队列的锁
+def setup(level='INFO', stream=None, background=True):
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+    handler = logging.StreamHandler(stream or sys.stdout)
+    handler.setFormatter(logging.Formatter('%(asctime)s %(process)d %(levelname)s %(name)s: %(message)s'))
+    root = logging.getLogger()
+    for h in list(root.handlers):
+        root.removeHandler(h)
+    root.setLevel(level)
+    if not background:
+        root.addHandler(handler)
+        return None
+    q = queue.Queue(-1)
+    root.addHandler(logging.handlers.QueueHandler(q))
+    _listener = logging.handlers.QueueListener(q, handler, respect_handler_level=True)
+    _listener.start()
+    return _listener
+
+
+# fork出来的子进程里没有监听线程，继承来的队列也不能再碰（锁可能在fork时被其他线程持有），直接丢弃，由子进程重新setup
+def _forget_listener():
+    global _listener
+    _listener = None
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_listener)
+
+
+# 进程退出前把队列中剩余的日志写完
+@atexit.register
+def shutdown():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,181 @@
+# 进程内的指标：计数器、仪表和直方图，供orm和中间件记录，由/metrics以Prometheus文本格式导出
+import bisect, threading
+
+# 延迟直方图默认的桶（秒）
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram(object):
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1) # 最后一个是+Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    # 按桶估算分位数（取所在桶的上界）
+    def quantile(self, q):
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        n = 0
+        for i, c in enumerate(self.counts):
+            n = n + c
+            if n >= rank:
+                return self.buckets[i] if i < len(self.buckets) else float('inf')
+        return float('inf')
+
+    # 累计计数的桶，格式与Prometheus的_bucket一致：[(上界, 计数), ...]
+    def cumulative(self):
+        L = []
+        n = 0
+        for i, c in enumerate(self.counts):
+            n = n + c
+            L.append((self.buckets[i] if i < len(self.buckets) else float('inf'), n))
+        return L
+
+    def stats(self):
+        return dict(count=self.count, sum=self.sum, avg=(self.sum / self.count) if self.count else 0.0,
+                    p50=self.quantile(0.5), p90=self.quantile(0.9), p99=self.quantile(0.99))
+
+
+# 按标签分组的直方图：key ==> Histogram，key的个数有上限，超出的都记到overflow_key下，防止无限增长
+class HistogramFamily(object):
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, max_keys=1000, overflow_key='other'):
+        self.buckets = buckets
+        self.max_keys = max_keys
+        self.overflow_key = overflow_key
+        self._items = dict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        h = self._items.get(key)
+        if h is None:
+            with self._lock:
+                if key not in self._items and len(self._items) >= self.max_keys:
+                    key = self.overflow_key
+                h = self._items.get(key)
+                if h is None:
+                    h = self._items[key] = Histogram(self.buckets)
+        return h
+
+    def observe(self, key, value):
+        self.get(key).observe(value)
+
+    def items(self):
+        return list(self._items.items())
+
+
+# 以下为Prometheus文本格式的导出：各模块用register()登记一个采集函数，返回若干行文本
+_collectors = []
+
+
+def register(collector):
+    _collectors.append(collector)
+    return collector
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# 多进程模式下由app为每个worker设置（worker序号和pid），加到该worker输出的每一个样本上，各worker的序列互不混淆
+_process_labels = ''
+# 多进程模式下每个worker在worker_port + 序号上单独提供/metrics，单进程时为None
+worker_port = None
+
+
+def set_process_labels(labels):
+    global _process_labels
+    _process_labels = ','.join('%s="%s"' % (k, _escape(v)) for k, v in labels)
+
+
+def _add_process_labels(line):
+    if not _process_labels or not line or line.startswith('#'):
+        return line
+    # 指标名里没有空格和{，第一个{在第一个空格之前说明已经带了标签
+    i = line.find(' ')
+    j = line.find('{')
+    if j != -1 and j < i:
+        return '%s{%s,%s' % (line[:j], _process_labels, line[j + 1:])
+    return '%s{%s}%s' % (line[:i], _process_labels, line[i:])
+
+
+def render():
+    L = []
+    for collector in _collectors:
+        L.extend(collector())
+    if _process_labels:
+        L = [_add_process_labels(line) for line in L]
+    L.append('')
+    return '\n'.join(L)
+
+
+def _escape(v):
+    return str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, _escape(v)) for k, v in labels)
+
+
+def format_value(v):
+    if v == float('inf'):
+        return '+Inf'
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+# 把一个直方图输出为name_bucket/name_sum/name_count三组样本，labels是[(名称, 值), ...]
+def format_histogram(name, labels, h):
+    L = []
+    for le, n in h.cumulative():
+        L.append('%s_bucket%s %s' % (name, format_labels(list(labels) + [('le', format_value(le))]), n))
+    L.append('%s_sum%s %s' % (name, format_labels(labels), format_value(h.sum)))
+    L.append('%s_count%s %s' % (name, format_labels(labels), h.count))
+    return L
+
+
+# HTTP请求的指标，按(method, 路由模板)分组，由app.metrics_factory记录
+class RequestMetrics(object):
+
+    def __init__(self):
+        self.latency = HistogramFamily()
+        self.responses = dict() # (method, route, status) ==> 次数
+        self.bytes = dict() # (method, route) ==> 响应字节数
+        self.in_flight = 0
+
+    def observe(self, method, route, status, size, elapsed):
+        key = (method, route)
+        self.latency.observe(key, elapsed)
+        skey = (method, route, status)
+        self.responses[skey] = self.responses.get(skey, 0) + 1
+        self.bytes[key] = self.bytes.get(key, 0) + size
+
+    def collect(self):
+        L = ['# HELP http_request_duration_seconds HTTP request latency by route.',
+             '# TYPE http_request_duration_seconds histogram']
+        for key, h in sorted(self.latency.items(), key=lambda kv: str(kv[0])):
+            method, route = key if isinstance(key, tuple) else ('', key)
+            L.extend(format_histogram('http_request_duration_seconds', [('method', method), ('route', route)], h))
+        L.append('# HELP http_responses_total HTTP responses by route and status code.')
+        L.append('# TYPE http_responses_total counter')
+        for (method, route, status), n in sorted(self.responses.items()):
+            L.append('http_responses_total%s %s' % (format_labels([('method', method), ('route', route), ('status', status)]), n))
+        L.append('# HELP http_response_bytes_total Bytes sent in HTTP response bodies by route.')
+        L.append('# TYPE http_response_bytes_total counter')
+        for (method, route), n in sorted(self.bytes.items()):
+            L.append('http_response_bytes_total%s %s' % (format_labels([('method', method), ('route', route)]), n))
+        L.append('# HELP http_requests_in_flight HTTP requests currently being handled.')
+        L.append('# TYPE http_requests_in_flight gauge')
+        L.append('http_requests_in_flight %s' % self.in_flight)
+        return L
+
+
+http = RequestMetrics()
+register(http.collect)
@@ -1,6 +1,6 @@
 import time, uuid
 
-from orm import Model, StringField, BooleanField, FloatField, TextField
+from orm import Model, StringField, BooleanField, FloatField, TextField, Index
 
 def next_id():
     return '%015d%s000' % (int(time.time() * 1000), uuid.uuid4().hex)
@@ -10,6 +10,10 @@ def next_id():
 # 这个实例本质上是个dict（继承自Model）
 class User(Model):
     __table__ = 'users'
+    __indexes__ = (
+        Index('email', unique=True), # 登录和注册时按email查找
+        Index('created_at')
+    )
 
     # 初始化类属性，并将各个属性转换为field类或其子类
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)') # 主键就是id
@@ -22,6 +26,9 @@ class User(Model):
 
 class Blog(Model):
     __table__ = 'blogs'
+    __indexes__ = (
+        Index('created_at'),
+    )
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
     user_id = StringField(ddl='varchar(50)')
@@ -29,16 +36,23 @@ class Blog(Model):
     user_image = StringField(ddl='varchar(500)')
     name = StringField(ddl='varchar(50)')
     summary = StringField(ddl='varchar(200)')
-    content = TextField()
+    content = TextField(ddl='mediumtext')
+    html_content = TextField(ddl='mediumtext', nullable=True) # 写入时预先渲染好的markdown
     created_at = FloatField(default=time.time)
 
 class Comment(Model):
     __table__ = 'comments'
+    __indexes__ = (
+        Index('created_at'),
+        Index('blog_id', 'created_at'), # 日志页按blog_id取评论并按时间排序
+        Index('user_id') # 删除用户时按user_id更新评论
+    )
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
     blog_id = StringField(ddl='varchar(50)')
     user_id = StringField(ddl='varchar(50)')
     user_name = StringField(ddl='varchar(50)')
     user_image = StringField(ddl='varchar(500)')
-    content = TextField()
+    content = TextField(ddl='mediumtext')
+    html_content = TextField(ddl='mediumtext', nullable=True)
     created_at = FloatField(default=time.time)
\ No newline at end of file
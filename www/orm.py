@@ -1,20 +1,50 @@
 # 一处异步，处处异步
-import asyncio, logging, aiomysql
+import asyncio, logging, re, time, random, itertools, functools, contextlib, contextvars, aiomysql
 
+import metrics
+from shared import Counters
+from metrics import Histogram, HistogramFamily
 
+
+# SQL日志是DEBUG级别，并且只按SQL_LOG_SAMPLE_RATE的比例采样输出，避免每条SQL都写一次日志
+SQL_LOG_SAMPLE_RATE = 1.0
+
+
+def set_log_sample_rate(rate):
+    global SQL_LOG_SAMPLE_RATE
+    SQL_LOG_SAMPLE_RATE = rate
+
+
+# 参数里有密码摘要、邮箱等，只记录语句和参数个数
 def log(sql, args=()):
-    logging.info('SQL: %s' % sql)
+    if logging.root.isEnabledFor(logging.DEBUG) and (SQL_LOG_SAMPLE_RATE >= 1 or random.random() < SQL_LOG_SAMPLE_RATE):
+        logging.debug('SQL: %s (%s args)', sql, len(args) if args else 0)
 
 
 # 我们需要创建一个全局的连接池，每个HTTP请求都可以从连接池中直接获取数据库连接。使用连接池的好处是不必频繁地打开和关闭数据库连接，而是能复用就尽量复用
 # **kw表示传入的是不限长度的dict（这里应该传入config里的db）
+# kw['replicas']是只读从库的列表，每一项只需写出与主库不同的配置（如host），SELECT会被分配到从库上
 async def create_pool(loop, **kw):
     logging.info('create database connection pool...')
-    global __pool
+    global __pool, __replicas, __replica_policy, __replica_retry
+    __pool = await _create_pool(loop, **kw)
+    __replicas = []
+    for r in kw.get('replicas', None) or []:
+        opts = dict(kw)
+        opts.update(r)
+        logging.info('create replica connection pool: %s:%s' % (opts.get('host', 'localhost'), opts.get('port', 3306)))
+        __replicas.append(await _create_pool(loop, **opts))
+    __replica_policy = kw.get('replica_policy', 'round_robin')
+    __replica_retry = kw.get('replica_retry', 30)
+    global SLOW_QUERY_SECONDS
+    SLOW_QUERY_SECONDS = kw.get('slow_query', SLOW_QUERY_SECONDS)
+
+
+async def _create_pool(loop, **kw):
     # 调用aiomysql中的方法创建连接池并设定初始属性
     # dict有一个get方法，如果dict中有对应的value值，则返回对应于key的value值，否则返回默认值，例如下面的host，如果dict里面没有
     # 'host',则返回后面的默认值，也就是'localhost'
-    __pool = await aiomysql.create_pool(
+    return await aiomysql.create_pool(
         # 连接池的初始化数据
         host=kw.get('host', 'localhost'),
         port=kw.get('port', 3306),
@@ -29,38 +59,267 @@ async def create_pool(loop, **kw):
     )
 
 
+# 读写分离：SELECT默认走从库，INSERT/UPDATE/DELETE走主库
+# 同一个请求（协程上下文）里一旦写过主库，之后的读也固定走主库，保证读到自己刚写的数据
+__pool = None
+__replicas = []
+__replica_policy = 'round_robin'
+__replica_retry = 30
+_replica_down = dict() # 从库 ==> 暂停使用到的时间
+_round_robin = itertools.count()
+_pin_primary = contextvars.ContextVar('pin_primary', default=False)
+_wrote = contextvars.ContextVar('wrote', default=False)
+_tx = contextvars.ContextVar('transaction', default=None)
+
+
+# 让当前请求的读操作都走主库（比如客户端刚写过数据，带着read-your-writes的cookie回来）
+def pin_primary(pin=True):
+    _pin_primary.set(pin)
+
+
+# 当前请求是否写过主库
+def has_written():
+    return _wrote.get()
+
+
+def _mark_written():
+    _wrote.set(True)
+    _pin_primary.set(True)
+
+
+# 选择读操作使用的连接池：没有可用从库或已固定主库时返回主库
+def _read_pool():
+    if not __replicas or _pin_primary.get() or _tx.get() is not None:
+        return __pool
+    now = time.time()
+    alive = [p for p in __replicas if _replica_down.get(p, 0) <= now]
+    if not alive:
+        return __pool
+    if __replica_policy == 'least_busy':
+        # 正在使用的连接最少的从库
+        return min(alive, key=lambda p: p.size - p.freesize)
+    return alive[next(_round_robin) % len(alive)]
+
+
+# SQL和连接池的统计：按归一化的SQL记录执行耗时、返回行数，记录等待连接的时间
+# 超过SLOW_QUERY_SECONDS的语句记入慢查询日志，stats()返回全部数据
+SLOW_QUERY_SECONDS = 0.5
+_sql_latency = HistogramFamily()
+_sql_rows = dict() # 归一化SQL ==> 累计返回/影响的行数
+_acquire_wait = Histogram()
+_RE_SPACES = re.compile(r'\s+')
+_RE_VALUES = re.compile(r'(\([?, ]+\))(?:, \([?, ]+\))+')
+_RE_IN = re.compile(r'\bin \([?, ]+\)', re.I)
+
+
+# 归一化：合并空白，多行VALUES和IN (?, ?, ...)只保留一组，使不同参数个数的同类语句落在一起
+@functools.lru_cache(maxsize=1024)
+def normalize_sql(sql):
+    sql = _RE_SPACES.sub(' ', sql.strip())
+    sql = _RE_VALUES.sub(r'\1, ...', sql)
+    return _RE_IN.sub('in (...)', sql)
+
+
+def _record(sql, elapsed, rows, args=None):
+    key = normalize_sql(sql)
+    _sql_latency.observe(key, elapsed)
+    if key in _sql_rows or len(_sql_rows) < _sql_latency.max_keys:
+        _sql_rows[key] = _sql_rows.get(key, 0) + (rows if rows and rows > 0 else 0)
+    if elapsed >= SLOW_QUERY_SECONDS:
+        # 参数里可能有密码摘要、邮箱等，只记录个数
+        logging.warning('slow query (%.3fs, %s rows, %s args): %s' % (elapsed, rows, len(args) if args else 0, key))
+
+
+# 从连接池取连接，并记录等待的时间
+async def _acquire(pool):
+    start = time.time()
+    conn = await pool
+    _acquire_wait.observe(time.time() - start)
+    return conn
+
+
+# 取执行SQL用的连接：在事务中时使用事务固定的连接（同一时间只允许一条语句在上面执行），否则从连接池取
+# 同一个协程在遍历iter_select的过程中又在事务里执行SQL会等待自己，直接报错
+@contextlib.asynccontextmanager
+async def _connection(pool):
+    tx = _tx.get()
+    if tx is not None:
+        task = asyncio.current_task()
+        if tx.owner is task:
+            raise RuntimeError('Transaction connection is busy, finish iter_select first.')
+        async with tx.lock:
+            tx.owner = task
+            try:
+                yield tx.conn
+            finally:
+                tx.owner = None
+    else:
+        with (await _acquire(pool)) as conn:
+            yield conn
+
+
+def _pool_stats(pool):
+    return dict(size=pool.size, free=pool.freesize, in_use=pool.size - pool.freesize,
+                minsize=pool.minsize, maxsize=pool.maxsize)
+
+
+def stats():
+    pools = dict()
+    if __pool is not None:
+        pools['primary'] = _pool_stats(__pool)
+    for i, p in enumerate(__replicas):
+        pools['replica%s' % i] = _pool_stats(p)
+    statements = dict()
+    for sql, h in _sql_latency.items():
+        statements[sql] = h.stats()
+        statements[sql]['rows'] = _sql_rows.get(sql, 0)
+    return dict(pools=pools, acquire_wait=_acquire_wait.stats(), statements=statements, slow_query=SLOW_QUERY_SECONDS)
+
+
+# 导出到/metrics的数据库指标
+@metrics.register
+def _collect_metrics():
+    L = ['# HELP db_query_duration_seconds SQL statement latency by normalized statement.',
+         '# TYPE db_query_duration_seconds histogram']
+    for sql, h in _sql_latency.items():
+        L.extend(metrics.format_histogram('db_query_duration_seconds', [('sql', sql)], h))
+    L.append('# HELP db_query_rows_total Rows returned or affected by normalized statement.')
+    L.append('# TYPE db_query_rows_total counter')
+    for sql, n in list(_sql_rows.items()):
+        L.append('db_query_rows_total%s %s' % (metrics.format_labels([('sql', sql)]), n))
+    L.append('# HELP db_pool_acquire_wait_seconds Time spent waiting for a pool connection.')
+    L.append('# TYPE db_pool_acquire_wait_seconds histogram')
+    L.extend(metrics.format_histogram('db_pool_acquire_wait_seconds', [], _acquire_wait))
+    L.append('# HELP db_pool_connections Connections in each pool by state.')
+    L.append('# TYPE db_pool_connections gauge')
+    for name, s in stats()['pools'].items():
+        for state in ('in_use', 'free', 'maxsize'):
+            L.append('db_pool_connections%s %s' % (metrics.format_labels([('pool', name), ('state', state)]), s[state]))
+    return L
+
+
+# 编译好的SQL缓存的条数
+SQL_CACHE_SIZE = 1024
+
+
+# 把SQL中的?占位符转换为MySQL驱动使用的%s，结果按SQL字符串缓存
+# 引号和反引号里的?是字面量，保持不变；驱动会对整条SQL做%格式化，所以原有的%都要转义成%%
+@functools.lru_cache(maxsize=SQL_CACHE_SIZE)
+def compile_sql(sql):
+    L = []
+    quote = None
+    i, n = 0, len(sql)
+    while i < n:
+        c = sql[i]
+        if c == '%':
+            L.append('%%')
+        elif quote:
+            L.append(c)
+            if c == '\\' and quote != '`' and i + 1 < n:
+                # 转义字符连同下一个字符原样保留
+                i += 1
+                L.append('%%' if sql[i] == '%' else sql[i])
+            elif c == quote:
+                quote = None
+        elif c in ('\'', '"', '`'):
+            quote = c
+            L.append(c)
+        elif c == '?':
+            L.append('%s')
+        else:
+            L.append(c)
+        i += 1
+    return ''.join(L)
+
+
 # 要执行SELECT语句，我们用select函数执行，需要传入SQL语句和SQL参数
-async def select(sql, args, size=None):
+# dict_rows=False时每行返回tuple，省去驱动为每行构造dict的开销
+# 从库连不上或执行出错时，暂停使用该从库replica_retry秒，并改到主库重试
+async def select(sql, args, size=None, dict_rows=True):
     log(sql, args)
-    global __pool
+    pool = _read_pool()
+    if pool is not __pool:
+        try:
+            return (await _select(pool, sql, args, size, dict_rows))
+        except (aiomysql.OperationalError, OSError) as e:
+            logging.warning('replica failed, fall back to primary: %s' % e)
+            _replica_down[pool] = time.time() + __replica_retry
+    return (await _select(__pool, sql, args, size, dict_rows))
+
+
+async def _select(pool, sql, args, size, dict_rows):
     # 在连接池中建立一个数据库连接
-    with (await __pool) as conn: # 使用该语句的前提是已经创建了进程池，因为这句话是在函数定义里面，所以可以这样用
+    async with _connection(pool) as conn: # 使用该语句的前提是已经创建了进程池；在事务中时是事务固定的连接
         # 定义连接的指针
-        cur = await conn.cursor(aiomysql.DictCursor)
+        cur = await conn.cursor(aiomysql.DictCursor if dict_rows else aiomysql.Cursor)
+        start = time.time()
         # SQL语句的占位符是?，而MySQL的占位符是%s，select()函数在内部自动替换
-        await cur.execute(sql.replace('?', '%s'), args or ())
+        await cur.execute(compile_sql(sql), args or ())
         if size:
             rs = await cur.fetchmany(size) # 一次性返回size条查询结果，结果是一个list，里面是tuple（findNumber）
         else:
             rs = await cur.fetchall() # 一次性返回所有的查询结果（findAll）
+        _record(sql, time.time() - start, len(rs), args)
         # 关闭数据库连接
         await cur.close() # 关闭游标，不用手动关闭conn，因为是在with语句里面，会自动关闭，因为是select，所以不需要提交事务(commit)
-        logging.info('rows returned: %s' % len(rs))
+        logging.debug('rows returned: %s', len(rs))
         return rs # 返回查询结果，元素是tuple的list
 
 
+# 异步生成器没有async for之外的关闭时机，提前退出时要显式aclose()才会执行finally归还连接
+# 即contextlib.aclosing，Python 3.10起才有
+@contextlib.asynccontextmanager
+async def aclosing(agen):
+    try:
+        yield agen
+    finally:
+        await agen.aclose()
+
+
+# 流式SELECT：使用服务端游标（SSCursor/SSDictCursor），结果不在客户端一次性缓存，每次取size行yield出去
+# 遍历期间独占一个连接，正常结束时归还连接池；提前break、出错或被取消时，结果集还没读完，
+# 直接关闭该连接（连接池会丢弃已关闭的连接），而不是把剩下的行全部读完；在事务中时连接还要继续用，只能把剩下的行读完
+async def iter_select(sql, args, size=100, dict_rows=True):
+    log(sql, args)
+    in_tx = _tx.get() is not None
+    async with _connection(_read_pool()) as conn:
+        cur = await conn.cursor(aiomysql.SSDictCursor if dict_rows else aiomysql.SSCursor)
+        done = False
+        rows = 0
+        start = time.time()
+        try:
+            await cur.execute(compile_sql(sql), args or ())
+            while True:
+                rs = await cur.fetchmany(size)
+                if not rs:
+                    break
+                rows = rows + len(rs)
+                yield rs
+            done = True
+        finally:
+            # 耗时包含调用方处理每一批数据的时间
+            _record(sql, time.time() - start, rows, args)
+            if done or in_tx:
+                await cur.close()
+            else:
+                conn.close()
+
+
 # 要执行INSERT、UPDATE、DELETE语句，可以定义一个通用的execute()函数，因为这3种SQL的执行都需要相同的参数，以及返回一个整数表示影响的行数
 # execute()函数和select()函数所不同的是，cursor对象不返回结果集，而是通过rowcount返回结果数
 async def execute(sql, args):
     log(sql)
-    with (await __pool) as conn:
+    _mark_written()
+    async with _connection(__pool) as conn:
         try:
             # 因为execute类型sql操作返回结果只有行号，不需要dict
             cur = await conn.cursor()
+            start = time.time()
             # 和上面同理，执行占位符转换
-            await cur.execute(sql.replace('?', '%s'), args)
+            await cur.execute(compile_sql(sql), args)
             # 影响的行动数
             affected = cur.rowcount
+            _record(sql, time.time() - start, affected, args)
             await cur.close()
         except BaseException as e:
             raise
@@ -68,6 +327,164 @@ async def execute(sql, args):
         return affected
 
 
+# 内存中维护的各表行数，启动时从数据库初始化，save/remove时增减，并定期与数据库校准
+# 这样不带条件的count(id)就不用每次都去扫一遍索引
+# 计数放在共享内存里（导入时创建，prefork时各worker继承同一块），一个worker的写入其他worker立即可见
+# 每张表的槽按Model定义的顺序分配；超出槽数的表不缓存行数，总是查询数据库
+_models = [] # 所有Model子类，由ModelMetaclass登记
+_row_counts = Counters()
+_count_slots = dict() # table ==> _row_counts中的序号
+_RE_COUNT_ALL = re.compile(r'^\s*count\(\s*(\*|1|`?\w+`?)\s*\)\s*$', re.I)
+
+
+def adjust_count(table, delta):
+    tx = _tx.get()
+    if tx is not None:
+        # 事务提交之后才生效，回滚时丢弃
+        tx.deltas.append((table, delta))
+        return
+    i = _count_slots.get(table)
+    if i is not None:
+        _row_counts.add(i, delta)
+
+
+# 用精确的count(*)初始化/校准所有表的行数
+async def seed_counts(models=None):
+    for model in (models or _models):
+        i = _count_slots.get(model.__table__)
+        if i is None:
+            continue
+        n = await model.findNumber('count(*)', exact=True)
+        _row_counts.set(i, n)
+        logging.info('row count of %s: %s' % (model.__table__, n))
+
+
+# 定期校准行数，修正其他进程写入或失败事务带来的偏差
+async def reconcile_counts(interval=300):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await seed_counts()
+        except Exception as e:
+            logging.exception(e)
+
+
+class _Transaction(object):
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = asyncio.Lock()
+        self.owner = None # 正在使用连接的协程
+        self.deltas = [] # 提交后才生效的行数变化：[(table, delta)]
+
+
+# 事务：async with orm.transaction(): 里面所有的select/execute/iter_select和Model方法都使用同一个主库连接，
+# 正常结束时提交一次，抛出异常时回滚；连接通过contextvars传递，嵌套使用时并入外层事务
+@contextlib.asynccontextmanager
+async def transaction():
+    if _tx.get() is not None:
+        yield
+        return
+    _mark_written()
+    with (await _acquire(__pool)) as conn:
+        tx = _Transaction(conn)
+        token = _tx.set(tx)
+        try:
+            await conn.begin()
+            yield
+        except BaseException:
+            _tx.reset(token)
+            await _rollback(conn)
+            raise
+        _tx.reset(token)
+        start = time.time()
+        try:
+            await conn.commit()
+        except BaseException:
+            await _rollback(conn)
+            raise
+        _record('COMMIT', time.time() - start, 0)
+    for table, delta in tx.deltas:
+        adjust_count(table, delta)
+
+
+# 回滚失败时连接状态未知，关闭连接，归还时连接池会丢弃它
+async def _rollback(conn):
+    try:
+        await conn.rollback()
+    except Exception as e:
+        logging.warning('rollback failed, close connection: %s' % e)
+        conn.close()
+
+
+# 参数在SQL语句里大约占多少字节，只用于控制批量语句的大小
+def _approx_size(values):
+    n = 0
+    for v in values:
+        if isinstance(v, str):
+            n = n + len(v.encode('utf-8')) + 3
+        elif isinstance(v, (bytes, bytearray)):
+            n = n + len(v) + 3
+        else:
+            n = n + 24
+    return n
+
+
+# 在同一个事务里依次执行多条INSERT/UPDATE/DELETE，全部成功才提交，返回每条语句影响的行数
+async def execute_batch(statements):
+    async with transaction():
+        affected = []
+        for sql, args in statements:
+            affected.append(await execute(sql, args))
+        return affected
+
+
+# 以下按查询的形状缓存Model生成的SQL，同一种查询只拼接一次字符串
+# limit_shape：0表示没有limit，1表示limit ?，2表示limit ?, ?
+@functools.lru_cache(maxsize=SQL_CACHE_SIZE)
+def _select_sql(cls, where, orderBy, limit_shape):
+    sql = [cls.__select__]
+    if where:
+        sql.append('where')
+        sql.append(where)
+    if orderBy:
+        sql.append('order by')
+        sql.append(orderBy)
+    if limit_shape == 1:
+        sql.append('limit ?')
+    elif limit_shape == 2:
+        sql.append('limit ?, ?')
+    return ' '.join(sql)
+
+
+# direction：'after'取游标之后（更旧）的行，'before'取游标之前（更新）的行
+@functools.lru_cache(maxsize=SQL_CACHE_SIZE)
+def _cursor_sql(cls, where, direction):
+    conds = ['(%s)' % where] if where else []
+    seek = '(`created_at`, `%s`)' % cls.__primary_key__
+    if direction == 'after':
+        conds.append('%s < (?, ?)' % seek)
+    elif direction == 'before':
+        conds.append('%s > (?, ?)' % seek)
+    # 往前翻页时按升序取离游标最近的limit条，再反转回降序
+    order = 'asc' if direction == 'before' else 'desc'
+    sql = [cls.__select__]
+    if conds:
+        sql.append('where')
+        sql.append(' and '.join(conds))
+    sql.append('order by `created_at` %s, `%s` %s limit ?' % (order, cls.__primary_key__, order))
+    return ' '.join(sql)
+
+
+@functools.lru_cache(maxsize=SQL_CACHE_SIZE)
+def _number_sql(cls, selectField, where):
+    sql = ['select %s _num_ from `%s`' % (selectField, cls.__table__)]
+    if where:
+        sql.append('where')
+        sql.append(where)
+    return ' '.join(sql)
+
+
 # 注意到Model只是一个基类，要将具体的子类如User的映射信息读取出来需要通过metaclass：ModelMetaclass
 # 这样，任何继承自Model的类（比如User），会自动通过ModelMetaclass扫描映射关系，并存储到自身的类属性如__table__、__mappings__中
 # 然后，我们往Model类添加class方法，就可以让所有子类调用class方法
@@ -79,6 +496,64 @@ def create_args_string(num):
     return ', '.join(L)
 
 
+# 紧凑的只读行对象：用__slots__保存各列的值，不再是每行一个dict
+# 由ModelMetaclass根据__mappings__为每个Model生成一个子类（Model.__row__），直接用tuple游标的结果构造
+# 支持属性访问和dict式的下标访问，vars(row)/row.__dict__返回dict，所以JSON序列化和模板的用法与Model一致
+class Row(object):
+    __slots__ = ()
+    __columns__ = ()
+    __model__ = None
+
+    def __getitem__(self, key):
+        if key not in self.__columns__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in self.__columns__:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self.__columns__
+
+    def __iter__(self):
+        return iter(self.__columns__)
+
+    def __len__(self):
+        return len(self.__columns__)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default) if key in self.__columns__ else default
+
+    def keys(self):
+        return list(self.__columns__)
+
+    def values(self):
+        return [getattr(self, k) for k in self.__columns__]
+
+    def items(self):
+        return [(k, getattr(self, k)) for k in self.__columns__]
+
+    # 需要save/update时转换回完整的Model实例
+    def toModel(self):
+        return self.__model__(**self.__dict__)
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, ', '.join('%s=%r' % kv for kv in self.items()))
+
+
+def create_row_class(name, columns):
+    # 和namedtuple一样生成按位置赋值的__init__和转换为dict的函数，比循环getattr/setattr快
+    src = 'def __init__(self, %s):\n' % ', '.join(columns)
+    src = src + ''.join('    self.%s = %s\n' % (c, c) for c in columns)
+    src = src + 'def _asdict(self):\n    return {%s}\n' % ', '.join("'%s': self.%s" % (c, c) for c in columns)
+    ns = dict()
+    exec(src, ns)
+    return type(name, (Row,), dict(__slots__=tuple(columns), __columns__=tuple(columns), __init__=ns['__init__'],
+                                   _asdict=ns['_asdict'], __dict__=property(ns['_asdict'])))
+
+
 # 创建所有ORM框架的元类，使得以元类的方法创造实例（获得映射关系）
 class ModelMetaclass(type):
 
@@ -108,6 +583,13 @@ class ModelMetaclass(type):
                     fields.append(k)
         if not primaryKey:
             raise RuntimeError('Primary key not found.')
+        columns = set((v.name or k) for k, v in mappings.items())
+        indexes = tuple(attrs.get('__indexes__', ()))
+        for index in indexes:
+            for c in index.columns:
+                if c not in columns:
+                    raise RuntimeError('Index %s refers to unknown column: %s' % (index.name, c))
+        attrs['__indexes__'] = indexes
         for k in mappings.keys():
             attrs.pop(k)
         # 将除主键外的其他属性变成`id`, `name`这种形式，关于反引号``的用法，可以参考点击打开链接
@@ -119,9 +601,20 @@ class ModelMetaclass(type):
         # 构造默认的SELECT, INSERT, UPDATE和DELETE的SQL语句:
         attrs['__select__'] = 'select `%s`, %s from `%s`' % (primaryKey, ', '.join(escaped_fields), tableName)
         attrs['__insert__'] = 'insert into `%s` (%s, `%s`) values (%s)' % (tableName, ', '.join(escaped_fields), primaryKey, create_args_string(len(escaped_fields) + 1))
+        # 多行INSERT：__insert_many__后面接若干个__insert_row__
+        attrs['__insert_many__'] = 'insert into `%s` (%s, `%s`) values ' % (tableName, ', '.join(escaped_fields), primaryKey)
+        attrs['__insert_row__'] = '(%s)' % create_args_string(len(escaped_fields) + 1)
         attrs['__update__'] = 'update `%s` set %s where `%s`=?' % (tableName, ', '.join(map(lambda f: '`%s`=?' % (mappings.get(f).name or f), fields)), primaryKey)
         attrs['__delete__'] = 'delete from `%s` where `%s`=?' % (tableName, primaryKey)
-        return type.__new__(cls, name, bases, attrs)
+        attrs['__find__'] = '%s where `%s`=?' % (attrs['__select__'], primaryKey)
+        # 紧凑行类，列顺序与__select__一致
+        attrs['__row__'] = create_row_class(name + 'Row', [primaryKey] + fields)
+        model = type.__new__(cls, name, bases, attrs)
+        model.__row__.__model__ = model
+        _models.append(model)
+        if tableName not in _count_slots and len(_count_slots) < len(_row_counts):
+            _count_slots[tableName] = len(_count_slots)
+        return model
 
 
 # 首先要定义的是所有ORM映射的基类Model
@@ -161,43 +654,78 @@ class Model(dict, metaclass=ModelMetaclass):
     # 类方法有类变量cls传入，从而可以用cls做一些相关的处理。并且有子类继承时，调用该类方法时，传入的类变量cls是子类，而非父类。
     # 类方法的第一个参数应该是cls
     # 由哪一个类调用的方法，方法内的cls就是哪一个类的引用，这个参数和实例方法的第一个参数是self类似
+    # compact=True时返回cls.__row__紧凑行对象（只读列表接口使用），否则返回Model实例
     @classmethod
     async def findAll(cls, where=None, args=None, **kw):
         # find objects by where clause
-        sql = [cls.__select__]
-        if where:
-            sql.append('where')
-            sql.append(where)
-        if args is None:
-            args = []
-        orderBy = kw.get('orderBy', None)
-        if orderBy:
-            sql.append('order by')
-            sql.append(orderBy)
+        args = list(args) if args else []
         limit = kw.get('limit', None)
+        limit_shape = 0
         if limit is not None:
-            sql.append('limit')
             if isinstance(limit, int):
-                sql.append('?')
+                limit_shape = 1
                 args.append(limit)
             elif isinstance(limit, tuple) and len(limit) == 2 :
-                sql.append('?, ?')
+                limit_shape = 2
                 args.extend(limit)
             else:
                 raise ValueError('Invalid limit value: %s' % str(limit))
-        rs = await select(' '.join(sql), args) # 返回的rs是一个元素是tuple的list，此处返回的size是默认值，即返回所有查询结果
+        sql = _select_sql(cls, where, kw.get('orderBy', None), limit_shape)
+        if kw.get('compact', False):
+            row = cls.__row__
+            return [row(*r) for r in await select(sql, args, dict_rows=False)]
+        rs = await select(sql, args) # 返回的rs是一个元素是tuple的list，此处返回的size是默认值，即返回所有查询结果
         # 返回对象列表
         return [cls(**r) for r in rs] # **r 是关键字参数，构成了一个cls类的列表，其实就是每一条记录对应的类实例
 
+    # 异步生成器，逐行遍历全部结果而不一次性载入内存，用于导出、重建索引、补数据等
+    # async for blog in Blog.iterAll(orderBy='created_at desc'): ...
+    # 如果可能提前退出循环，用orm.aclosing(Blog.iterAll(...))包一层，保证连接立即归还
+    # （提前退出时关闭的只是iterAll本身，这里再负责关闭内层的iter_select）
+    @classmethod
+    async def iterAll(cls, where=None, args=None, chunk_size=100, **kw):
+        sql = _select_sql(cls, where, kw.get('orderBy', None), 0)
+        compact = kw.get('compact', False)
+        row = cls.__row__ if compact else None
+        async with aclosing(iter_select(sql, args, chunk_size, dict_rows=not compact)) as it:
+            async for rs in it:
+                for r in rs:
+                    yield row(*r) if compact else cls(**r)
+
+    # 基于游标的分页（keyset/seek），游标是(created_at, 主键)，结果总是按created_at desc, 主键desc排列
+    # after：取比游标更旧的limit条（下一页）；before：取比游标更新的limit条（上一页）
+    # 不再使用LIMIT offset，翻到多深都只是一次索引定位
+    @classmethod
+    async def findByCursor(cls, where=None, args=None, after=None, before=None, limit=10, compact=False):
+        if after is not None and before is not None:
+            raise ValueError('Only one of after and before can be set.')
+        args = list(args) if args else []
+        direction = None
+        if after is not None:
+            direction = 'after'
+            args.extend(after)
+        if before is not None:
+            direction = 'before'
+            args.extend(before)
+        args.append(limit)
+        rs = await select(_cursor_sql(cls, where, direction), args, dict_rows=not compact)
+        if before is not None:
+            rs = list(reversed(rs))
+        if compact:
+            row = cls.__row__
+            return [row(*r) for r in rs]
+        return [cls(**r) for r in rs]
+
+    # 不带条件的count查询直接使用内存中的行数，exact=True时强制查询数据库
     @classmethod
-    async def findNumber(cls, selectField, where=None, args=None):
+    async def findNumber(cls, selectField, where=None, args=None, exact=False):
         # find number by select and where
-        sql = ['select %s _num_ from `%s`' % (selectField, cls.__table__)]
-        if where:
-            sql.append('where')
-            sql.append(where)
+        if not exact and not where and cls.__table__ in _count_slots and _RE_COUNT_ALL.match(selectField):
+            n = _row_counts.get(_count_slots[cls.__table__])
+            if n is not None:
+                return n
         # 搜寻数据库
-        rs = await select(' '.join(sql), args, 1) # 此处返回的size是1，即返回1条查询结果
+        rs = await select(_number_sql(cls, selectField, where), args, 1) # 此处返回的size是1，即返回1条查询结果
         if len(rs) == 0:
             return None
         return rs[0]['_num_']
@@ -205,11 +733,27 @@ class Model(dict, metaclass=ModelMetaclass):
     @classmethod
     async def find(cls, pk):
         # find object by primary key
-        rs = await select('%s where `%s`=?' % (cls.__select__, cls.__primary_key__), [pk], 1)
+        rs = await select(cls.__find__, [pk], 1)
         if len(rs) == 0:
             return None
         return cls(**rs[0])
 
+    # 按条件批量更新，只发一条UPDATE语句：set是"`col`=?"形式的赋值，args依次对应set和where中的占位符，返回影响的行数
+    @classmethod
+    async def updateWhere(cls, set, where, args=None):
+        if not where:
+            raise ValueError('Missing where clause for updateWhere.')
+        return await execute('update `%s` set %s where %s' % (cls.__table__, set, where), args or [])
+
+    # 按条件批量删除，只发一条DELETE语句，返回影响的行数
+    @classmethod
+    async def deleteWhere(cls, where, args=None):
+        if not where:
+            raise ValueError('Missing where clause for deleteWhere.')
+        rows = await execute('delete from `%s` where %s' % (cls.__table__, where), args or [])
+        adjust_count(cls.__table__, -rows)
+        return rows
+
     # 往Model类添加实例方法，就可以让所有子类调用实例方法：
     async def save(self):
         args = list(map(self.getValueOrDefault, self.__fields__))
@@ -218,6 +762,38 @@ class Model(dict, metaclass=ModelMetaclass):
         rows = await execute(self.__insert__, args)
         if rows != 1:
             logging.warn('failed to insert record: affected rows: %s' % rows)
+        adjust_count(self.__table__, rows)
+
+    # 批量插入：每batch_size条拼成一条多行INSERT ... VALUES (...), (...)，所有批次在一个事务中执行
+    # 每条语句的参数大小还不超过batch_bytes（按UTF-8估算），大文本的日志500条一批很容易超过max_allowed_packet（MySQL 5.7默认4MB）
+    # 返回每个批次影响的行数
+    @classmethod
+    async def saveAll(cls, instances, batch_size=500, batch_bytes=1024 * 1024):
+        statements = []
+        batch = []
+        args = []
+        size = 0
+        for inst in instances:
+            row = list(map(inst.getValueOrDefault, cls.__fields__))
+            row.append(inst.getValueOrDefault(cls.__primary_key__))
+            n = _approx_size(row)
+            if batch and (len(batch) >= batch_size or size + n > batch_bytes):
+                statements.append((cls.__insert_many__ + ', '.join([cls.__insert_row__] * len(batch)), args))
+                batch = []
+                args = []
+                size = 0
+            batch.append(inst)
+            args.extend(row)
+            size = size + n
+        if batch:
+            statements.append((cls.__insert_many__ + ', '.join([cls.__insert_row__] * len(batch)), args))
+        if not statements:
+            return []
+        affected = await execute_batch(statements)
+        adjust_count(cls.__table__, sum(affected))
+        for n, rows in enumerate(affected):
+            logging.info('saveAll %s: batch %s affected rows: %s' % (cls.__table__, n, rows))
+        return affected
 
     async def update(self):
         args = list(map(self.getValue, self.__fields__))
@@ -231,15 +807,17 @@ class Model(dict, metaclass=ModelMetaclass):
         rows = await execute(self.__delete__, args)
         if rows != 1:
             logging.warn('failed to remove by primary key: affected rows: %s' % rows)
+        adjust_count(self.__table__, -rows)
 
 # 定义Field和各种Field子类（用来给元类做判断的，因为元类的attrs是子类的所有元素（包括__init__）所以要用一个类把参数筛选出来）
 class Field(object):
 
-    def __init__(self, name, column_type, primary_key, default):
+    def __init__(self, name, column_type, primary_key, default, nullable=False):
         self.name = name
         self.column_type = column_type
         self.primary_key = primary_key
         self.default = default
+        self.nullable = nullable # 生成DDL时是否允许null
 
     def __str__(self):
         return '<%s, %s:%s>' % (self.__class__.__name__, self.column_type, self.name)
@@ -266,5 +844,19 @@ class FloatField(Field):
 
 class TextField(Field):
 
-    def __init__(self, name=None, default=None):
-        super().__init__(name, 'text', False, default)
\ No newline at end of file
+    def __init__(self, name=None, default=None, ddl='text', nullable=False):
+        super().__init__(name, ddl, False, default, nullable)
+
+# 在Model中用__indexes__声明索引，如__indexes__ = (Index('blog_id', 'created_at'), Index('email', unique=True))
+# 列名按顺序组成复合索引，索引名默认为idx_列名_列名，由schema.py生成DDL或与线上表结构比对
+class Index(object):
+
+    def __init__(self, *columns, unique=False, name=None):
+        if not columns:
+            raise ValueError('Index needs at least one column.')
+        self.columns = columns
+        self.unique = unique
+        self.name = name or 'idx_%s' % '_'.join(columns)
+
+    def __str__(self):
+        return '<%s%s: %s>' % ('Unique ' if self.unique else '', self.name, ', '.join(self.columns))
\ No newline at end of file
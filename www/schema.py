@@ -0,0 +1,143 @@
+# 由models.py生成表结构：CREATE TABLE语句（schema.sql）以及与线上数据库比对后的ALTER TABLE语句
+# 用法：python3 schema.py create > ../schema.sql
+#       python3 schema.py diff     （连接config中的数据库，只打印语句，不执行）
+import asyncio, logging, re, sys
+
+import orm
+from config import configs
+from models import User, Blog, Comment
+
+MODELS = (User, Blog, Comment)
+
+# information_schema里显示的类型名与DDL里的写法不同
+_TYPE_ALIASES = {'bool': 'tinyint(1)', 'boolean': 'tinyint(1)', 'real': 'double', 'integer': 'int'}
+_RE_INT_WIDTH = re.compile(r'^(bigint|int|mediumint|smallint)\(\d+\)')
+
+
+def normalize_type(t):
+    t = t.strip().lower()
+    t = _TYPE_ALIASES.get(t, t)
+    # 整数的显示宽度不影响存储（MySQL 8.0.19起也不再显示），tinyint(1)即bool除外
+    return _RE_INT_WIDTH.sub(r'\1', t)
+
+
+# [(列名, Field)]，主键在前，其余按声明的顺序
+def columns_of(model):
+    L = []
+    for k, f in model.__mappings__.items():
+        L.append((f.name or k, f))
+    L.sort(key=lambda c: not c[1].primary_key)
+    return L
+
+
+def column_sql(name, f):
+    return '`%s` %s%s' % (name, f.column_type, '' if f.nullable else ' not null')
+
+
+def index_sql(index):
+    return '%skey `%s` (%s)' % ('unique ' if index.unique else '', index.name, ', '.join('`%s`' % c for c in index.columns))
+
+
+def create_table_sql(model):
+    pk = model.__mappings__[model.__primary_key__].name or model.__primary_key__
+    L = ['    %s' % column_sql(name, f) for name, f in columns_of(model)]
+    L.extend('    %s' % index_sql(index) for index in model.__indexes__)
+    L.append('    primary key (`%s`)' % pk)
+    return 'create table %s (\n%s\n) engine=innodb default charset=utf8;' % (model.__table__, ',\n'.join(L))
+
+
+def schema_sql(models=MODELS):
+    db = configs.db
+    L = ['-- schema.sql', '',
+         '-- 由www/schema.py根据models.py生成，修改表结构请改models.py后执行：python3 schema.py create > ../schema.sql', '',
+         'drop database if exists %s;' % db.db, '',
+         'create database %s;' % db.db, '',
+         'use %s;' % db.db, '',
+         # 不把配置里的密码写进生成的文件，由执行的人替换占位符后再取消注释
+         "-- grant select, insert, update, delete on %s.* to '%s'@'localhost' identified by '<password>';" % (db.db, db.user)]
+    for model in models:
+        L.append('')
+        L.append(create_table_sql(model))
+    return '\n'.join(L) + '\n'
+
+
+# 线上表结构：返回(columns, indexes)，columns为[(列名, 类型, 可否为null)]，indexes为{索引名: (unique, (列名, ...))}，表不存在时返回(None, None)
+async def live_schema(table):
+    rs = await orm.select('select `column_name` as `name`, `column_type` as `type`, `is_nullable` as `nullable` '
+                          'from information_schema.columns where `table_schema`=database() and `table_name`=? '
+                          'order by `ordinal_position`', [table])
+    if not rs:
+        return None, None
+    columns = [(r['name'], r['type'], r['nullable'] == 'YES') for r in rs]
+    rs = await orm.select('select `index_name` as `name`, `non_unique` as `non_unique`, `column_name` as `column` '
+                          'from information_schema.statistics where `table_schema`=database() and `table_name`=? '
+                          'order by `index_name`, `seq_in_index`', [table])
+    indexes = dict()
+    for r in rs:
+        unique, cols = indexes.get(r['name'], (not int(r['non_unique']), ()))
+        indexes[r['name']] = (unique, cols + (r['column'],))
+    return columns, indexes
+
+
+# 比对model与线上表结构，返回要执行的语句（同一张表的改动合并成一条ALTER TABLE，只重建一次表）
+# 线上多出来的列和索引不会删除，只以注释的形式列出
+def diff_table(model, columns, indexes):
+    if columns is None:
+        return [create_table_sql(model)]
+    table = model.__table__
+    live = dict((name, (t, nullable)) for name, t, nullable in columns)
+    clauses = []
+    notes = []
+    prev = None
+    for name, f in columns_of(model):
+        if name not in live:
+            clauses.append('add column %s %s' % (column_sql(name, f), 'after `%s`' % prev if prev else 'first'))
+        else:
+            t, nullable = live[name]
+            if normalize_type(t) != normalize_type(f.column_type) or nullable != f.nullable:
+                clauses.append('modify column %s' % column_sql(name, f))
+        prev = name
+    declared = set(name for name, f in columns_of(model))
+    for name, t, nullable in columns:
+        if name not in declared:
+            notes.append('-- %s.%s (%s) is not declared in the model' % (table, name, t))
+    for index in model.__indexes__:
+        current = indexes.get(index.name)
+        if current is None:
+            clauses.append('add %s' % index_sql(index))
+        elif current != (index.unique, tuple(index.columns)):
+            clauses.append('drop key `%s`' % index.name)
+            clauses.append('add %s' % index_sql(index))
+    names = set(index.name for index in model.__indexes__)
+    for name, (unique, cols) in sorted(indexes.items()):
+        if name != 'PRIMARY' and name not in names:
+            notes.append('-- %s key %s (%s) is not declared in the model' % (table, name, ', '.join(cols)))
+    L = notes
+    if clauses:
+        L.append('alter table `%s`\n    %s;' % (table, ',\n    '.join(clauses)))
+    return L
+
+
+async def diff(loop, models=MODELS):
+    await orm.create_pool(loop=loop, **configs.db)
+    # information_schema要读主库
+    orm.pin_primary()
+    L = []
+    for model in models:
+        columns, indexes = await live_schema(model.__table__)
+        L.extend(diff_table(model, columns, indexes))
+    return L
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    if len(sys.argv) != 2 or sys.argv[1] not in ('create', 'diff'):
+        print('usage: python3 schema.py <create|diff>')
+        sys.exit(1)
+    if sys.argv[1] == 'create':
+        sys.stdout.write(schema_sql())
+    else:
+        loop = asyncio.get_event_loop()
+        statements = loop.run_until_complete(diff(loop))
+        print('\n'.join(statements) if statements else '-- schema is up to date')
+        loop.close()
@@ -0,0 +1,222 @@
+# 全文搜索：日志(name/summary/content)和评论(content)的进程内倒排索引
+# 英文/数字按单词切分，中日韩文字按相邻两字(bigram)和单字切分，这样不需要分词词典也能搜到任意连续的词
+# 写操作的handler调用index_blog/index_comment/remove增量更新，启动时从数据库整体建一次（可以配置为定期重建）
+# 只适用于单进程部署：prefork多worker时每个worker各建一份完整索引、各自扫全表，
+# 写入只进入处理它的那个worker的索引，不同worker的搜索结果在下次重建前会不一致
+import asyncio, re, math, time, logging
+
+from collections import Counter
+
+import metrics
+
+# 假名、CJK统一汉字（含扩展A和兼容汉字）、韩文音节
+_CJK = '\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff'
+_RE_TOKEN = re.compile('[0-9a-z_]+|[%s]+' % _CJK)
+_RE_CJK = re.compile('[%s]' % _CJK)
+MAX_TOKEN_LENGTH = 40
+
+# 各字段的权重：标题里出现的词比正文里出现的更重要
+BLOG_FIELDS = (('name', 3), ('summary', 2), ('content', 1))
+COMMENT_FIELDS = (('content', 1),)
+
+# 重建索引时连续占用事件循环超过这么多秒就让出一次（一篇几KB的日志切词就要几毫秒，按篇数让出会卡住请求太久）
+REBUILD_YIELD_SECONDS = 0.01
+
+# BM25参数
+K1 = 1.2
+B = 0.75
+
+
+# 把文本切成词：英文数字转小写按单词，中日韩连续文字切成bigram
+# 建索引时每个汉字还单独作为一个词，这样只有一个字的查询也能匹配；查询时两个字以上的只用bigram
+def tokenize(text, query=False):
+    tokens = []
+    if not text:
+        return tokens
+    for m in _RE_TOKEN.finditer(text.lower()):
+        s = m.group()
+        if _RE_CJK.match(s):
+            if len(s) == 1:
+                tokens.append(s)
+            else:
+                tokens.extend([s[i:i + 2] for i in range(len(s) - 1)])
+                if not query:
+                    tokens.extend(s)
+        elif len(s) <= MAX_TOKEN_LENGTH:
+            tokens.append(s)
+    return tokens
+
+
+class SearchIndex(object):
+
+    def __init__(self):
+        self._postings = dict() # term ==> {doc: 加权词频}
+        self._docs = dict() # doc ==> (长度, 词集合, 展示用的信息)，doc = (kind, id)
+        self._total_length = 0
+
+    def __len__(self):
+        return len(self._docs)
+
+    # 加入或替换一篇文档，fields为[(text, weight)]
+    def add(self, kind, id, fields, meta):
+        doc = (kind, id)
+        if doc in self._docs:
+            self.remove(kind, id)
+        tf = dict()
+        length = 0
+        for text, weight in fields:
+            tokens = tokenize(text)
+            length = length + len(tokens)
+            for t, n in Counter(tokens).items():
+                tf[t] = tf.get(t, 0) + n * weight
+        for t, n in tf.items():
+            self._postings.setdefault(t, dict())[doc] = n
+        self._docs[doc] = (length, tuple(tf), meta)
+        self._total_length = self._total_length + length
+
+    def remove(self, kind, id):
+        doc = (kind, id)
+        item = self._docs.pop(doc, None)
+        if item is None:
+            return False
+        length, terms, meta = item
+        for t in terms:
+            postings = self._postings[t]
+            del postings[doc]
+            if not postings:
+                del self._postings[t]
+        self._total_length = self._total_length - length
+        return True
+
+    # 查询所有词都出现的文档，按BM25得分排序（同分时新的在前），返回(总数, [(score, kind, id, meta)])
+    def search(self, query, kind=None, offset=0, limit=10):
+        terms = list(dict.fromkeys(tokenize(query, query=True)))
+        if not terms or not self._docs:
+            return 0, []
+        postings = [self._postings.get(t) for t in terms]
+        if not all(postings):
+            return 0, []
+        # 从最短的倒排表开始求交集
+        postings.sort(key=len)
+        docs = set(postings[0])
+        for p in postings[1:]:
+            docs.intersection_update(p)
+            if not docs:
+                return 0, []
+        if kind is not None:
+            docs = [d for d in docs if d[0] == kind]
+        n = len(self._docs)
+        avg = (self._total_length / n) or 1.0
+        idfs = [(p, math.log(1 + (n - len(p) + 0.5) / (len(p) + 0.5))) for p in postings]
+        results = []
+        for doc in docs:
+            length, terms, meta = self._docs[doc]
+            norm = K1 * (1 - B + B * length / avg)
+            score = 0.0
+            for p, idf in idfs:
+                f = p[doc]
+                score = score + idf * f * (K1 + 1) / (f + norm)
+            results.append((score, doc[0], doc[1], meta))
+        results.sort(key=lambda r: (r[0], r[3].get('created_at', 0)), reverse=True)
+        return len(results), results[offset:offset + limit]
+
+    def stats(self):
+        return dict(docs=len(self._docs), terms=len(self._postings), tokens=self._total_length)
+
+
+_index = SearchIndex()
+_ready = False
+_replay = None # 重建期间的增量更新，重建完成后重放到新索引上
+_last_rebuild = None
+
+
+def _apply(op, *args):
+    getattr(_index, op)(*args)
+    if _replay is not None:
+        _replay.append((op, args))
+
+
+# Blog/Comment（Model或紧凑行）==> (fields, meta)
+def _blog_doc(blog):
+    return [(getattr(blog, f), w) for f, w in BLOG_FIELDS], \
+        dict(name=blog.name, summary=blog.summary, user_name=blog.user_name, created_at=blog.created_at)
+
+
+def _comment_doc(c):
+    return [(getattr(c, f), w) for f, w in COMMENT_FIELDS], \
+        dict(blog_id=c.blog_id, user_name=c.user_name, content=c.content[:200], created_at=c.created_at)
+
+
+def index_blog(blog):
+    _apply('add', 'blog', blog.id, *_blog_doc(blog))
+
+
+def index_comment(comment):
+    _apply('add', 'comment', comment.id, *_comment_doc(comment))
+
+
+def remove(kind, id):
+    _apply('remove', kind, id)
+
+
+def search(query, kind=None, offset=0, limit=10):
+    return _index.search(query, kind, offset, limit)
+
+
+# 从数据库流式读取全部日志和评论建立新索引，建好之后再替换掉旧的，期间搜索仍然使用旧索引
+async def rebuild():
+    global _index, _ready, _replay, _last_rebuild
+    from models import Blog, Comment
+    start = time.time()
+    index = SearchIndex()
+    _replay = []
+    busy = time.time()
+    try:
+        async for blog in Blog.iterAll(compact=True):
+            index.add('blog', blog.id, *_blog_doc(blog))
+            if time.time() - busy > REBUILD_YIELD_SECONDS:
+                # 让出事件循环，重建期间不至于卡住正常请求
+                await asyncio.sleep(0)
+                busy = time.time()
+        async for c in Comment.iterAll(compact=True):
+            index.add('comment', c.id, *_comment_doc(c))
+            if time.time() - busy > REBUILD_YIELD_SECONDS:
+                await asyncio.sleep(0)
+                busy = time.time()
+        for op, args in _replay:
+            getattr(index, op)(*args)
+    finally:
+        _replay = None
+    _index = index
+    _ready = True
+    _last_rebuild = time.time()
+    logging.info('search index rebuilt in %.2fs: %s' % (_last_rebuild - start, index.stats()))
+
+
+# 启动时建立索引；interval不为0时之后定期重建，用来纠正绕过handler直接改数据库造成的偏差
+async def run(interval=0):
+    while True:
+        try:
+            await rebuild()
+        except Exception as e:
+            logging.exception(e)
+        if not interval:
+            return
+        await asyncio.sleep(interval)
+
+
+def stats():
+    s = _index.stats()
+    s.update(ready=_ready, last_rebuild=_last_rebuild)
+    return s
+
+
+@metrics.register
+def _collect_metrics():
+    s = _index.stats()
+    return ['# HELP search_index_documents Documents in the in-process search index.',
+            '# TYPE search_index_documents gauge',
+            'search_index_documents %s' % s['docs'],
+            '# HELP search_index_terms Distinct terms in the in-process search index.',
+            '# TYPE search_index_terms gauge',
+            'search_index_terms %s' % s['terms']]
@@ -0,0 +1,60 @@
+# 多个worker进程共享的失效计数，放在匿名共享内存里：在导入时（prefork的master进程fork之前）创建，子进程继承同一块内存
+# 某个key失效时把它的计数加一；各进程在命中本地缓存时比较计数，不一致就说明已经被某个进程失效过
+# key按crc32分到固定个数的槽里，不同的key落在同一个槽只会多一次未命中，不会读到旧数据
+# 只在同一台机器上由同一个master fork出来的进程之间共享
+import multiprocessing, time, zlib
+
+
+class Generations(object):
+
+    def __init__(self, slots=4096):
+        self._values = multiprocessing.RawArray('q', slots)
+        self._times = multiprocessing.RawArray('d', slots) # 最近一次失效的时间
+        self._lock = multiprocessing.Lock()
+
+    def _slot(self, key):
+        return zlib.crc32(key.encode('utf-8')) % len(self._values)
+
+    def get(self, key):
+        return self._values[self._slot(key)]
+
+    # 最近一次失效的时间戳，从未失效过时为0
+    def bumped_at(self, key):
+        return self._times[self._slot(key)]
+
+    # 加锁保证并发失效时每次都会让计数增加
+    def bump(self, key):
+        i = self._slot(key)
+        with self._lock:
+            self._values[i] += 1
+            self._times[i] = time.time()
+            return self._values[i]
+
+
+# 多个worker进程共享的计数（如各表行数），按固定的序号访问；没有设置过的槽读出None
+# 序号要在fork之前分配好（如按Model定义的顺序），各进程才能对上
+class Counters(object):
+
+    def __init__(self, slots=64):
+        self._values = multiprocessing.RawArray('q', slots)
+        self._known = multiprocessing.RawArray('b', slots)
+        self._lock = multiprocessing.Lock()
+
+    def __len__(self):
+        return len(self._values)
+
+    def get(self, i):
+        if not self._known[i]:
+            return None
+        return self._values[i]
+
+    def set(self, i, value):
+        with self._lock:
+            self._values[i] = value
+            self._known[i] = 1
+
+    # 没有设置过的槽不做增减，等set初始化
+    def add(self, i, delta):
+        with self._lock:
+            if self._known[i]:
+                self._values[i] += delta